@@ -1,7 +1,26 @@
+import time
+
+# Отсчёт холодного старта начинается до импорта тяжёлых библиотек
+STARTED_AT = time.perf_counter()
+
 import os
+import io
+import sys
+import csv
 import json
-from telegram import Update, Bot
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ConversationHandler, filters, ContextTypes
+import codecs
+import functools
+import unicodedata
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from telegram import Update, User, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ConversationHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.ext import BasePersistence, PersistenceInput, ExtBot, BaseRateLimiter
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from psycopg import AsyncCursor
+from psycopg.errors import UniqueViolation
 from psycopg_pool import AsyncConnectionPool
 import random
 import asyncio
@@ -9,29 +28,880 @@ import asyncio
 # Получаем токен и URL базы данных из переменных окружения
 TOKEN = os.getenv("TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
+# direct - прямое соединение с Postgres, запросы готовятся на сервере с первого выполнения;
+# pgbouncer - внешний пулер в режиме transaction, подготовленные запросы отключены
+DB_POOL_MODE = os.getenv("DB_POOL_MODE", "direct")
+if DB_POOL_MODE not in ('direct', 'pgbouncer'):
+    raise ValueError(f"DB_POOL_MODE должен быть direct или pgbouncer, а не {DB_POOL_MODE!r}")
+# Размер пула одного экземпляра, время простоя лишнего соединения и ожидания свободного, в секундах
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "600"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Имя бота из окружения позволяет не вызывать getMe при холодном старте
+BOT_USERNAME = os.getenv("BOT_USERNAME")
+COLD_START_BUDGET_MS = float(os.getenv("COLD_START_BUDGET_MS", "1500"))
+# Обработка апдейтов после ответа Telegram. Vercel замораживает функцию сразу после
+# ответа, поэтому по умолчанию апдейт обрабатывается до ответа; фоновый режим
+# включается (PROCESS_IN_BACKGROUND=1) только для постоянно работающего сервера aiohttp
+PROCESS_IN_BACKGROUND = os.getenv("PROCESS_IN_BACKGROUND", "0") == "1"
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "8"))
+RECENT_UPDATES_SIZE = 1024
+# Кэш чтений словаря: число записей и срок жизни записи в секундах (попадания - в /metrics)
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "1024"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "300"))
+# Ограничения Telegram на исходящие сообщения: всего в секунду, в один личный чат
+# и в одну группу, плюс допустимая серия подряд и число повторов после ответа 429
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_GLOBAL = float(os.getenv("RATE_LIMIT_GLOBAL", "30"))
+RATE_LIMIT_CHAT = float(os.getenv("RATE_LIMIT_CHAT", "1"))
+RATE_LIMIT_GROUP = 20 / 60
+RATE_LIMIT_BURST = 3
+RATE_LIMIT_RETRIES = 3
+CHAT_BUCKETS_SIZE = 1024
+# Трассировка апдейтов: JSON-строка в лог на каждый апдейт и маршрут /metrics для Prometheus
+LOG_TRACES = os.getenv("LOG_TRACES", "1") == "1"
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+# Сырые ответы старше этого срока удаляются командой compact (итоги остаются в history_daily)
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "90"))
+COMPACT_BATCH_SIZE = 5000
+# /memory считает процент по последним MEMORY_WINDOW ответам, их compact не трогает
+MEMORY_WINDOW = 5
 
 # Состояния для ConversationHandler
 PORTUGUESE, RUSSIAN, TEST_ANSWER, BULK_ADD, EDIT_PORTUGUESE, EDIT_RUSSIAN = range(6)
 
-# Инициализация бота
-bot = Bot(TOKEN)
-application = ApplicationBuilder().token(TOKEN).build()
+# Массовый импорт: размер пачки для COPY и размер блока при определении кодировки
+BULK_BATCH_SIZE = 2000
+# Прогресс импорта обновляется не чаще раза в столько секунд, а не после каждой пачки
+BULK_PROGRESS_INTERVAL = 2.5
+DECODE_CHUNK_SIZE = 64 * 1024
+BULK_ENCODINGS = ['utf-8', 'windows-1251']
+
+# Дубликаты определяются уникальным индексом по пользователю и нормализованной паре слов
+ON_CONFLICT_SKIP = "ON CONFLICT (user_id, normalize_word(portuguese), normalize_word(russian)) DO NOTHING"
+
+# Постраничный вывод тезауруса: страница ограничена длиной сообщения Telegram,
+# а не числом строк; за один запрос читаем не больше THESAURUS_FETCH_LIMIT строк
+MESSAGE_LIMIT = 4096
+THESAURUS_FETCH_LIMIT = 200
+THESAURUS_HEADER = "📖 *Тезаурус:*\n\n`ID | Португальский | Русский`\n" + "-" * 40 + "\n"
+
+# Тест: число вопросов и запас кандидатов, среди которых перемешиваются равные по приоритету слова
+TEST_SIZE = 25
+TEST_CANDIDATES = 4 * TEST_SIZE
+# Столбцы /export; файл в этом формате принимает /bulk_add
+EXPORT_COLUMNS = ('portuguese', 'russian', 'correct', 'incorrect', 'memory', 'due_at')
+# Степень запоминания по числу правильных среди последних MEMORY_WINDOW ответов
+MEMORY_PERCENT = {5: 100, 4: 75, 3: 50, 2: 25, 1: 0, 0: 0}
+# Число правильных ответов среди последних MEMORY_WINDOW по каждому слову пользователя
+RECENT_CORRECT_SQL = (
+    "SELECT word_id, SUM(correct) AS correct_count FROM ("
+    "  SELECT word_id, correct, "
+    "         ROW_NUMBER() OVER (PARTITION BY word_id ORDER BY timestamp DESC) AS rn "
+    "  FROM history WHERE user_id = %(user_id)s"
+    ") h WHERE rn <= %(window)s GROUP BY word_id"
+)
+
+# /search: сколько совпадений показывать
+SEARCH_LIMIT = 20
+
+# Проверка ответа: с какой длины слова прощается одна опечатка и с какой - две.
+# На коротких словах одна правка часто даёт другое слово: casa/cama, gato/rato
+TYPO_ONE_LENGTH = 6
+TYPO_TWO_LENGTH = 10
+
+# Тест с вариантами: кнопок на вопрос и сколько случайных слов берётся в запас для
+# неправильных вариантов (вместе со словами самого теста)
+QUIZ_OPTIONS = 4
+QUIZ_POOL_SIZE = 50
+
+# /stats: размер топа и максимальный период в днях для статистики за период
+STATS_TOP = 10
+STATS_MAX_DAYS = 365
+
+# Параметры SM-2: ответ без ошибки увеличивает лёгкость слова, ошибка уменьшает её
+# (не ниже SRS_MIN_EASE) и возвращает слово на повторение через SRS_RELEARN_MINUTES
+SRS_EASE_BONUS = 0.1
+SRS_EASE_PENALTY = 0.2
+SRS_MIN_EASE = 1.3
+SRS_RELEARN_MINUTES = 10
+
+# Этапы холодного старта, мс от начала импорта модуля
+STARTUP_TIMINGS = {}
+
+def mark_startup(stage):
+    STARTUP_TIMINGS.setdefault(stage, round((time.perf_counter() - STARTED_AT) * 1000, 1))
+
+def report_cold_start():
+    """Печатает разбивку холодного старта один раз, после первого обработанного апдейта."""
+    if 'reported' in STARTUP_TIMINGS:
+        return
+    mark_startup('first_update')
+    STARTUP_TIMINGS['reported'] = True
+    total = STARTUP_TIMINGS['first_update']
+    print(json.dumps({
+        'event': 'cold_start',
+        'timings_ms': {k: v for k, v in STARTUP_TIMINGS.items() if k != 'reported'},
+        'budget_ms': COLD_START_BUDGET_MS,
+        'within_budget': total <= COLD_START_BUDGET_MS,
+    }))
+
+class UpdateTrace:
+    """Куда ушло время одного апдейта: обработчик, ожидание соединения из пула,
+    каждый SQL-запрос и каждый вызов Telegram API."""
+
+    def __init__(self, update_id):
+        self.update_id = update_id
+        self.handler = None
+        self.started = time.perf_counter()
+        self.total_ms = None
+        self.pool_wait_ms = 0.0
+        self.queries = []
+        self.telegram = []
+
+    def finish(self):
+        self.total_ms = round((time.perf_counter() - self.started) * 1000, 1)
+
+    def to_dict(self):
+        return {
+            'update_id': self.update_id,
+            'handler': self.handler,
+            'total_ms': self.total_ms,
+            'pool_wait_ms': round(self.pool_wait_ms, 1),
+            'sql_ms': round(sum(query['ms'] for query in self.queries), 1),
+            'telegram_ms': round(sum(call['ms'] for call in self.telegram), 1),
+            'queries': self.queries,
+            'telegram': self.telegram,
+        }
+
+# Трассировка текущего апдейта; задачи, созданные внутри обработчика, видят её же
+current_trace = ContextVar('current_trace', default=None)
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 2)
+
+class Metrics:
+    """Накопительные счётчики по всем апдейтам экземпляра для /metrics."""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.updates = {}
+        self.queries = [0, 0.0, 0]
+        self.telegram = {}
+        self.pool_wait = 0.0
+
+    def observe(self, trace):
+        seconds = trace.total_ms / 1000
+        handler = self.updates.setdefault(trace.handler or 'none', [0, 0.0, [0] * len(self.BUCKETS)])
+        handler[0] += 1
+        handler[1] += seconds
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                handler[2][i] += 1
+        for query in trace.queries:
+            self.queries[0] += 1
+            self.queries[1] += query['ms'] / 1000
+            self.queries[2] += max(query['rows'], 0)
+        for call in trace.telegram:
+            method = self.telegram.setdefault(call['method'], [0, 0.0])
+            method[0] += 1
+            method[1] += call['ms'] / 1000
+        self.pool_wait += trace.pool_wait_ms / 1000
+
+    def render(self, pool_stats=None, cache_stats=None):
+        """Текстовый формат Prometheus."""
+        lines = ['# TYPE bot_update_duration_seconds histogram']
+        for handler, (count, total, buckets) in sorted(self.updates.items()):
+            for bound, n in zip(self.BUCKETS, buckets):
+                lines.append(f'bot_update_duration_seconds_bucket{{handler="{handler}",le="{bound}"}} {n}')
+            lines.append(f'bot_update_duration_seconds_bucket{{handler="{handler}",le="+Inf"}} {count}')
+            lines.append(f'bot_update_duration_seconds_sum{{handler="{handler}"}} {total:.6f}')
+            lines.append(f'bot_update_duration_seconds_count{{handler="{handler}"}} {count}')
+        lines += [
+            '# TYPE bot_sql_queries_total counter',
+            f'bot_sql_queries_total {self.queries[0]}',
+            '# TYPE bot_sql_duration_seconds_total counter',
+            f'bot_sql_duration_seconds_total {self.queries[1]:.6f}',
+            '# TYPE bot_sql_rows_total counter',
+            f'bot_sql_rows_total {self.queries[2]}',
+            '# TYPE bot_pool_wait_seconds_total counter',
+            f'bot_pool_wait_seconds_total {self.pool_wait:.6f}',
+            '# TYPE bot_telegram_requests_total counter',
+        ]
+        for method, (count, total) in sorted(self.telegram.items()):
+            lines.append(f'bot_telegram_requests_total{{method="{method}"}} {count}')
+        lines.append('# TYPE bot_telegram_duration_seconds_total counter')
+        for method, (count, total) in sorted(self.telegram.items()):
+            lines.append(f'bot_telegram_duration_seconds_total{{method="{method}"}} {total:.6f}')
+        # Значения AsyncConnectionPool.get_stats(): размеры пула и счётчики ожиданий
+        for key, value in sorted((pool_stats or {}).items()):
+            name = key if key.startswith('pool_') else f'pool_{key}'
+            lines.append(f'# TYPE bot_{name} gauge')
+            lines.append(f'bot_{name} {value}')
+        if cache_stats:
+            lines += [
+                '# TYPE bot_cache_hits_total counter',
+                f'bot_cache_hits_total {cache_stats["hits"]}',
+                '# TYPE bot_cache_misses_total counter',
+                f'bot_cache_misses_total {cache_stats["misses"]}',
+            ]
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class TimedCursor(AsyncCursor):
+    """Курсор, который записывает длительность и число строк каждого запроса в трассировку."""
+
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            trace = current_trace.get()
+            if trace:
+                sql = query if isinstance(query, str) else query.as_string(self)
+                trace.queries.append({
+                    'sql': ' '.join(sql.split())[:80],
+                    'ms': elapsed_ms(started),
+                    'rows': self.rowcount,
+                })
+
+class TimedRequest(HTTPXRequest):
+    """Запросы к Telegram API с замером времени каждого вызова."""
+
+    async def do_request(self, url, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, *args, **kwargs)
+        finally:
+            trace = current_trace.get()
+            if trace:
+                trace.telegram.append({'method': url.rsplit('/', 1)[-1], 'ms': elapsed_ms(started)})
+
+class TokenBucket:
+    """Ведро токенов: rate запросов в секунду в среднем и не больше capacity подряд."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """Сглаживает исходящие запросы под лимиты Telegram: общее ведро на бота и по ведру
+    на чат. Запросы без chat_id (answerCallbackQuery, getFile) не задерживаются.
+
+    На RetryAfter чат блокируется на указанное время, и запрос повторяется
+    до RATE_LIMIT_RETRIES раз, прежде чем ошибка уйдёт в обработчик.
+    """
+
+    def __init__(self, global_rate=RATE_LIMIT_GLOBAL, chat_rate=RATE_LIMIT_CHAT,
+                 group_rate=RATE_LIMIT_GROUP, max_retries=RATE_LIMIT_RETRIES):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = OrderedDict()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate if is_group else self.chat_rate, RATE_LIMIT_BURST)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > CHAT_BUCKETS_SIZE:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        max_retries = rate_limit_args if isinstance(rate_limit_args, int) else self.max_retries
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+                await self._global.acquire()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= max_retries:
+                    raise
+                attempt += 1
+                print(f"Telegram flood limit on {endpoint}: retry {attempt} in {e.retry_after}s")
+                if chat_id is None:
+                    await asyncio.sleep(e.retry_after)
+                else:
+                    self._chat_bucket(chat_id).block(e.retry_after)
+
+def coalesce(texts, separator='\n\n'):
+    """Склеивает соседние сообщения в одно, пока оно помещается в MESSAGE_LIMIT."""
+    messages = []
+    for text in texts:
+        if messages and len(messages[-1]) + len(separator) + len(text) <= MESSAGE_LIMIT:
+            messages[-1] += separator + text
+        else:
+            messages.append(text)
+    return messages
+
+class LazyConnectionPool(AsyncConnectionPool):
+    """Пул соединений, который открывается при первом обращении к базе, а не при импорте."""
+
+    @asynccontextmanager
+    async def connection(self, timeout=None):
+        started = time.perf_counter()
+        if self.closed:
+            await self.open()
+        async with super().connection(timeout) as conn:
+            mark_startup('first_db_connection')
+            trace = current_trace.get()
+            if trace:
+                trace.pool_wait_ms += elapsed_ms(started)
+            yield conn
+
+def create_pool(min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE):
+    """Пул соединений по настройкам DB_POOL_*.
+
+    В режиме direct prepare_threshold=0: каждый запрос готовится на сервере при первом
+    выполнении на соединении, дальше psycopg выполняет подготовленный оператор по тексту
+    запроса. За PgBouncer в режиме transaction соседние транзакции могут попасть
+    на разные серверные соединения, поэтому там подготовка отключена (None).
+    """
+    return LazyConnectionPool(
+        DATABASE_URL, min_size=min_size, max_size=max_size, open=False,
+        max_idle=DB_POOL_MAX_IDLE, timeout=DB_POOL_TIMEOUT,
+        kwargs={
+            'cursor_factory': TimedCursor,
+            'prepare_threshold': None if DB_POOL_MODE == 'pgbouncer' else 0,
+        })
+
+def requires_db(callback):
+    """Без базы отвечает об этом и завершает диалог, не вызывая обработчик."""
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not context.bot_data.get('db_pool'):
+            await update.effective_message.reply_text("❌ База данных не подключена!")
+            return ConversationHandler.END
+        return await callback(update, context)
+    return wrapper
+
+class ServerlessBot(ExtBot):
+    """Бот, который не ходит в getMe при старте, если имя задано в BOT_USERNAME,
+    и в любом случае запрашивает getMe не больше одного раза за жизнь экземпляра."""
+
+    async def get_me(self, *args, **kwargs):
+        if self._bot_user is None and BOT_USERNAME:
+            self._bot_user = User(
+                id=int(self.token.split(':')[0]), first_name=BOT_USERNAME,
+                is_bot=True, username=BOT_USERNAME)
+        if self._bot_user is not None:
+            return self._bot_user
+        return await super().get_me(*args, **kwargs)
+
+class RecentUpdates:
+    """Отсеивает повторно доставленные апдейты: сначала по LRU последних update_id
+    в памяти экземпляра, затем по таблице processed_updates, общей для всех экземпляров."""
+
+    def __init__(self, size=RECENT_UPDATES_SIZE):
+        self.size = size
+        self._seen = OrderedDict()
+
+    async def is_duplicate(self, pool, update_id):
+        if update_id in self._seen:
+            self._seen.move_to_end(update_id)
+            return True
+        self._seen[update_id] = True
+        if len(self._seen) > self.size:
+            self._seen.popitem(last=False)
+
+        if not pool:
+            return False
+        # Заодно удаляем записи старше суток: Telegram столько повторы не присылает
+        async with pool.connection() as conn:
+            async with conn.cursor() as c:
+                await c.execute(
+                    "WITH old AS ("
+                    "  DELETE FROM processed_updates WHERE received_at < CURRENT_TIMESTAMP - INTERVAL '1 day'"
+                    ") INSERT INTO processed_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING",
+                    (update_id,))
+                inserted = c.rowcount
+                await conn.commit()
+        return not inserted
+
+    async def forget(self, pool, update_id):
+        """Снимает отметку с апдейта, который не удалось обработать, чтобы повторная
+        доставка от Telegram не была отброшена как дубликат."""
+        self._seen.pop(update_id, None)
+        if not pool:
+            return
+        async with pool.connection() as conn:
+            await conn.execute("DELETE FROM processed_updates WHERE update_id = %s", (update_id,))
+            await conn.commit()
 
-async def init_db(pool):
+class WordCache:
+    """LRU-кэш чтений словаря с ограниченным сроком жизни записей.
+
+    Каждая запись помечена версией словаря пользователя из таблицы vocab_versions.
+    Версия читается вместе с сессией в load_session, а все, кто меняет словарь,
+    увеличивают её в своей транзакции, поэтому изменения с других экземпляров
+    становятся видны со следующего апдейта без отдельного запроса на проверку.
+    """
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def set_version(self, user_id, version):
+        self._versions[user_id] = version
+
+    def invalidate(self, user_id):
+        # До следующего load_session версия неизвестна, и словарь пользователя не кэшируется.
+        # После апдейта версию забывает PostgresPersistence.flush: её всё равно перечитают
+        self._versions.pop(user_id, None)
+
+    async def get(self, user_id, key, load):
+        """Возвращает закэшированное значение или вызывает load() и запоминает результат."""
+        version = self._versions.get(user_id)
+        entry = self._entries.get((user_id, key))
+        if entry and entry[0] == version and time.monotonic() - entry[1] < self.ttl:
+            self._entries.move_to_end((user_id, key))
+            self.hits += 1
+            return entry[2]
+
+        self.misses += 1
+        value = await load()
+        if version is not None:
+            self._entries[(user_id, key)] = (version, time.monotonic(), value)
+            self._entries.move_to_end((user_id, key))
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+            'entries': len(self._entries),
+        }
+
+async def bump_vocab_version(c, user_id):
+    """Увеличивает версию словаря пользователя; вызывается в транзакции, меняющей словарь."""
+    await c.execute(
+        "INSERT INTO vocab_versions (user_id, version) VALUES (%s, 1) "
+        "ON CONFLICT (user_id) DO UPDATE SET version = vocab_versions.version + 1",
+        (user_id,))
+
+class UpdateDispatcher:
+    """Обрабатывает апдейты в фоне: не больше UPDATE_CONCURRENCY одновременно
+    и строго по порядку поступления внутри одного чата."""
+
+    def __init__(self, concurrency=UPDATE_CONCURRENCY):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._chat_tails = {}
+        self._tasks = set()
+
+    def submit(self, key, process):
+        previous = self._chat_tails.get(key)
+        task = asyncio.create_task(self._run(previous, process))
+        self._chat_tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda done: self._finished(key, done))
+
+    async def _run(self, previous, process):
+        if previous:
+            # Ждём предыдущий апдейт этого чата, даже если он завершился ошибкой
+            await asyncio.wait({previous})
+        async with self._semaphore:
+            await process()
+
+    def _finished(self, key, task):
+        self._tasks.discard(task)
+        if self._chat_tails.get(key) is task:
+            del self._chat_tails[key]
+        if not task.cancelled() and task.exception():
+            print(f"Error processing update: {task.exception()}")
+
+    async def join(self):
+        while self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+# Версионированные миграции схемы. Запускаются отдельно: python api/webhook.py migrate
+MIGRATIONS = [
+    (1, 'базовые таблицы', [
+        '''CREATE TABLE IF NOT EXISTS thesaurus
+           (id SERIAL PRIMARY KEY, portuguese TEXT, russian TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS stats
+           (id INTEGER PRIMARY KEY, correct INTEGER DEFAULT 0, incorrect INTEGER DEFAULT 0,
+            FOREIGN KEY(id) REFERENCES thesaurus(id))''',
+        '''CREATE TABLE IF NOT EXISTS history
+           (id SERIAL PRIMARY KEY, word_id INTEGER, correct INTEGER,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(word_id) REFERENCES thesaurus(id))''',
+    ]),
+    # Покрывающий индекс для выборки последних ответов по слову (/memory)
+    (2, 'индекс истории ответов', [
+        '''CREATE INDEX IF NOT EXISTS history_word_id_timestamp_idx
+           ON history (word_id, timestamp DESC) INCLUDE (correct)''',
+    ]),
+    # Нормализованный ключ слова: без регистра, диакритики и пробелов по краям.
+    # Перед созданием индекса дубликаты сливаются в слово с меньшим ID вместе со stats и history
+    (3, 'уникальный нормализованный ключ слова', [
+        "CREATE EXTENSION IF NOT EXISTS unaccent",
+        '''CREATE OR REPLACE FUNCTION normalize_word(word TEXT) RETURNS TEXT
+           LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+           AS $$ SELECT lower(public.unaccent('public.unaccent'::regdictionary, btrim(word))) $$''',
+        '''CREATE TEMP TABLE thesaurus_duplicates ON COMMIT DROP AS
+           SELECT id, MIN(id) OVER (PARTITION BY normalize_word(portuguese), normalize_word(russian)) AS keep_id
+           FROM thesaurus''',
+        "DELETE FROM thesaurus_duplicates WHERE id = keep_id",
+        '''INSERT INTO stats (id, correct, incorrect)
+           SELECT d.keep_id, SUM(s.correct), SUM(s.incorrect)
+           FROM stats s JOIN thesaurus_duplicates d ON d.id = s.id GROUP BY d.keep_id
+           ON CONFLICT (id) DO UPDATE SET correct = stats.correct + EXCLUDED.correct,
+                                          incorrect = stats.incorrect + EXCLUDED.incorrect''',
+        "DELETE FROM stats USING thesaurus_duplicates d WHERE stats.id = d.id",
+        "UPDATE history SET word_id = d.keep_id FROM thesaurus_duplicates d WHERE history.word_id = d.id",
+        "DELETE FROM thesaurus USING thesaurus_duplicates d WHERE thesaurus.id = d.id",
+        '''CREATE UNIQUE INDEX IF NOT EXISTS thesaurus_normalized_key
+           ON thesaurus (normalize_word(portuguese), normalize_word(russian))''',
+    ]),
+    # Состояние диалогов и user_data между вызовами serverless-функции
+    (4, 'состояние диалогов', [
+        '''CREATE TABLE IF NOT EXISTS bot_sessions
+           (user_id BIGINT PRIMARY KEY, data JSONB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    ]),
+    # Строка stats заводится вместе со словом, чтобы выбор слов для теста шёл по индексам stats
+    (5, 'индексы для выбора слов теста', [
+        "ALTER TABLE stats ADD COLUMN IF NOT EXISTS last_seen TIMESTAMP",
+        "INSERT INTO stats (id) SELECT id FROM thesaurus ON CONFLICT (id) DO NOTHING",
+        "CREATE INDEX IF NOT EXISTS stats_incorrect_idx ON stats (incorrect DESC)",
+        "CREATE INDEX IF NOT EXISTS stats_last_seen_idx ON stats (last_seen NULLS FIRST)",
+    ]),
+    # Интервальное повторение (SM-2): новые слова сразу готовы к повторению
+    (6, 'расписание повторений', [
+        "ALTER TABLE stats ADD COLUMN IF NOT EXISTS ease REAL NOT NULL DEFAULT 2.5",
+        "ALTER TABLE stats ADD COLUMN IF NOT EXISTS interval_days REAL NOT NULL DEFAULT 0",
+        "ALTER TABLE stats ADD COLUMN IF NOT EXISTS repetitions INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE stats ADD COLUMN IF NOT EXISTS due_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP",
+        "CREATE INDEX IF NOT EXISTS stats_due_at_idx ON stats (due_at)",
+    ]),
+    # Недавно обработанные update_id для защиты от повторной доставки вебхука
+    (7, 'обработанные апдейты', [
+        '''CREATE TABLE IF NOT EXISTS processed_updates
+           (update_id BIGINT PRIMARY KEY, received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        "CREATE INDEX IF NOT EXISTS processed_updates_received_at_idx ON processed_updates (received_at)",
+    ]),
+    # Дневные итоги по словам для статистики за период без чтения history
+    (8, 'дневные итоги ответов', [
+        '''CREATE TABLE IF NOT EXISTS history_daily
+           (word_id INTEGER REFERENCES thesaurus(id) ON DELETE CASCADE, day DATE,
+            correct INTEGER NOT NULL DEFAULT 0, incorrect INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (word_id, day))''',
+        '''INSERT INTO history_daily (word_id, day, correct, incorrect)
+           SELECT word_id, timestamp::date, SUM(correct), SUM(1 - correct) FROM history GROUP BY 1, 2
+           ON CONFLICT (word_id, day) DO NOTHING''',
+        "CREATE INDEX IF NOT EXISTS history_daily_day_idx ON history_daily (day) INCLUDE (word_id, incorrect)",
+    ]),
+    # Удаление слова каскадом чистит stats и history; каскад и compact опираются на индексы
+    # history(word_id, timestamp) и history(timestamp)
+    (9, 'каскадное удаление и индекс для очистки истории', [
+        "ALTER TABLE stats DROP CONSTRAINT IF EXISTS stats_id_fkey",
+        "ALTER TABLE stats ADD CONSTRAINT stats_id_fkey FOREIGN KEY (id) REFERENCES thesaurus(id) ON DELETE CASCADE",
+        "ALTER TABLE history DROP CONSTRAINT IF EXISTS history_word_id_fkey",
+        '''ALTER TABLE history ADD CONSTRAINT history_word_id_fkey
+           FOREIGN KEY (word_id) REFERENCES thesaurus(id) ON DELETE CASCADE''',
+        "CREATE INDEX IF NOT EXISTS history_timestamp_idx ON history (timestamp)",
+    ]),
+    # Словарь у каждого пользователя свой. Существующие строки получают user_id = 0,
+    # забрать их себе можно командой: python api/webhook.py claim <user_id>
+    (10, 'словари пользователей', [
+        *(statement
+          for table in ('thesaurus', 'stats', 'history', 'history_daily')
+          for statement in (
+              f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS user_id BIGINT NOT NULL DEFAULT 0",
+              f"ALTER TABLE {table} ALTER COLUMN user_id DROP DEFAULT")),
+        '''CREATE UNIQUE INDEX IF NOT EXISTS thesaurus_user_normalized_key
+           ON thesaurus (user_id, normalize_word(portuguese), normalize_word(russian))''',
+        "DROP INDEX IF EXISTS thesaurus_normalized_key",
+        "CREATE INDEX IF NOT EXISTS thesaurus_user_id_idx ON thesaurus (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS stats_user_incorrect_idx ON stats (user_id, incorrect DESC)",
+        "CREATE INDEX IF NOT EXISTS stats_user_last_seen_idx ON stats (user_id, last_seen NULLS FIRST)",
+        "CREATE INDEX IF NOT EXISTS stats_user_due_at_idx ON stats (user_id, due_at)",
+        "DROP INDEX IF EXISTS stats_incorrect_idx",
+        "DROP INDEX IF EXISTS stats_last_seen_idx",
+        "DROP INDEX IF EXISTS stats_due_at_idx",
+        '''CREATE INDEX IF NOT EXISTS history_user_word_timestamp_idx
+           ON history (user_id, word_id, timestamp DESC) INCLUDE (correct)''',
+        '''CREATE INDEX IF NOT EXISTS history_daily_user_day_idx
+           ON history_daily (user_id, day) INCLUDE (word_id, incorrect)''',
+        "DROP INDEX IF EXISTS history_daily_day_idx",
+    ]),
+    (11, 'версии словарей для кэша', [
+        '''CREATE TABLE IF NOT EXISTS vocab_versions (
+            user_id BIGINT PRIMARY KEY,
+            version BIGINT NOT NULL
+        )''',
+    ]),
+    # Триграммные индексы для /search: похожие слова (%) и подстроки (LIKE) без полного просмотра
+    (12, 'триграммный поиск', [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        '''CREATE INDEX IF NOT EXISTS thesaurus_portuguese_trgm_idx
+           ON thesaurus USING gin (normalize_word(portuguese) gin_trgm_ops)''',
+        '''CREATE INDEX IF NOT EXISTS thesaurus_russian_trgm_idx
+           ON thesaurus USING gin (normalize_word(russian) gin_trgm_ops)''',
+    ]),
+]
+
+async def migrate(pool):
+    """Применяет недостающие миграции, каждую в своей транзакции."""
     async with pool.connection() as conn:
         async with conn.cursor() as c:
-            await c.execute("DROP TABLE IF EXISTS stats CASCADE")
-            await c.execute('''CREATE TABLE IF NOT EXISTS thesaurus 
-                             (id SERIAL PRIMARY KEY, portuguese TEXT, russian TEXT)''')
-            await c.execute('''CREATE TABLE IF NOT EXISTS stats 
-                             (id INTEGER PRIMARY KEY, correct INTEGER DEFAULT 0, incorrect INTEGER DEFAULT 0, 
-                              FOREIGN KEY(id) REFERENCES thesaurus(id))''')
-            await c.execute('''CREATE TABLE IF NOT EXISTS history 
-                             (id SERIAL PRIMARY KEY, word_id INTEGER, correct INTEGER, 
-                              timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                              FOREIGN KEY(word_id) REFERENCES thesaurus(id))''')
+            await c.execute('''CREATE TABLE IF NOT EXISTS schema_migrations
+                             (version INTEGER PRIMARY KEY, description TEXT,
+                              applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
             await conn.commit()
 
+            for version, description, statements in MIGRATIONS:
+                # Блокировка не даёт двум параллельным запускам применить миграцию дважды
+                await c.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+                await c.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+                if await c.fetchone():
+                    await conn.rollback()
+                    continue
+                for statement in statements:
+                    await c.execute(statement)
+                await c.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                    (version, description))
+                await conn.commit()
+                print(f"Applied migration {version}: {description}")
+
+# Хранение состояния между вызовами
+TEST_SESSION_KEYS = ('test_words', 'test_index', 'test_direction', 'correct_answer', 'current_word_id',
+                     'quiz_pool', 'quiz_options')
+
+def pack_user_data(user_data):
+    """Компактная форма user_data: тест хранится как ID слов и битовая маска направлений."""
+    packed = {k: v for k, v in user_data.items() if k not in TEST_SESSION_KEYS}
+    if 'test_words' in user_data:
+        directions = 0
+        for i, direction in enumerate(user_data['test_direction']):
+            if direction == 'ru_to_pt':
+                directions |= 1 << i
+        packed['test'] = {
+            'ids': [word[0] for word in user_data['test_words']],
+            'directions': directions,
+            'index': user_data['test_index'],
+        }
+        if 'quiz_pool' in user_data:
+            packed['test']['quiz'] = {'pool': user_data['quiz_pool'], 'options': user_data['quiz_options']}
+    return packed
+
+def unpack_user_data(packed, words):
+    """Восстанавливает user_data; words - {id: (id, portuguese, russian)} для слов теста."""
+    user_data = {k: v for k, v in packed.items() if k != 'test'}
+    test = packed.get('test')
+    if test:
+        test_words, test_direction = [], []
+        index = test['index']
+        for i, word_id in enumerate(test['ids']):
+            if word_id not in words:
+                # Слово удалили посреди теста - пропускаем его
+                if i < test['index']:
+                    index -= 1
+                continue
+            test_words.append(words[word_id])
+            test_direction.append('ru_to_pt' if test['directions'] >> i & 1 else 'pt_to_ru')
+        user_data['test_words'] = test_words
+        user_data['test_direction'] = test_direction
+        user_data['test_index'] = index
+        if index < len(test_words):
+            word_id, portuguese, russian = test_words[index]
+            user_data['correct_answer'] = russian if test_direction[index] == 'pt_to_ru' else portuguese
+            user_data['current_word_id'] = word_id
+        if 'quiz' in test:
+            user_data['quiz_pool'] = test['quiz']['pool']
+            user_data['quiz_options'] = test['quiz']['options']
+    return user_data
+
+class PostgresPersistence(BasePersistence):
+    """Хранит user_data и состояния ConversationHandler в таблице bot_sessions,
+    по одной строке на пользователя.
+
+    Перед апдейтом строка пользователя читается одним запросом (load_session),
+    изменения копятся в памяти экземпляра, а flush() после апдейта записывает строку,
+    если она изменилась, и убирает пользователя из памяти. Тем же запросом читается
+    версия словаря для WordCache.
+    """
+
+    def __init__(self, pool, word_cache=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False))
+        self.pool = pool
+        self.word_cache = word_cache
+        self._sessions = {}
+        self._words = {}
+        self._dirty = set()
+
+    def _session(self, user_id):
+        return self._sessions.setdefault(user_id, {'user_data': {}, 'conversations': {}})
+
+    async def load_session(self, application, update):
+        user = update.effective_user
+        if not user:
+            return
+
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as c:
+                await c.execute(
+                    "SELECT s.data, ("
+                    "  SELECT json_agg(json_build_array(t.id, t.portuguese, t.russian)) FROM thesaurus t "
+                    "  WHERE t.id IN (SELECT jsonb_array_elements_text(s.data->'user_data'->'test'->'ids')::int)"
+                    "), COALESCE(v.version, 0) "
+                    "FROM (SELECT %s::bigint AS user_id) u "
+                    "LEFT JOIN bot_sessions s ON s.user_id = u.user_id "
+                    "LEFT JOIN vocab_versions v ON v.user_id = u.user_id",
+                    (user.id,))
+                session, words, version = await c.fetchone()
+
+        if self.word_cache:
+            self.word_cache.set_version(user.id, version)
+        # Если прошлая запись не удалась, состояние в памяти новее, чем в базе
+        if user.id not in self._dirty:
+            if session:
+                self._sessions[user.id] = session
+                self._words[user.id] = {word[0]: tuple(word) for word in words or []}
+            else:
+                self._sessions.pop(user.id, None)
+                self._words.pop(user.id, None)
+
+        # Состояние диалогов проверяется до refresh_user_data, поэтому подставляем его сразу
+        conversations = self._session(user.id)['conversations']
+        for name, states in application._conversation_handler_conversations.items():
+            for key in [key for key in states if key[-1] == user.id]:
+                states.data.pop(key)
+            states.update_no_track({
+                tuple(int(part) for part in key.split(':')[1:]): state
+                for key, state in conversations.items() if key.split(':')[0] == name
+            })
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        conversations = self._session(key[-1])['conversations']
+        conversation_key = ':'.join([name, *map(str, key)])
+        if conversations.get(conversation_key) == new_state:
+            return
+        if new_state is None:
+            conversations.pop(conversation_key, None)
+        else:
+            conversations[conversation_key] = new_state
+        self._dirty.add(key[-1])
+
+    async def update_user_data(self, user_id, data):
+        packed = pack_user_data(data)
+        session = self._session(user_id)
+        if session['user_data'] != packed:
+            session['user_data'] = packed
+            self._dirty.add(user_id)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._session(user_id)['user_data'] = {}
+        self._dirty.add(user_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        session = self._sessions.get(user_id)
+        if session is None:
+            return
+        user_data.clear()
+        user_data.update(unpack_user_data(session['user_data'], self._words.get(user_id, {})))
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self, user_id=None):
+        """Записывает изменённые сессии и убирает их из памяти: сессию пользователя после
+        его апдейта или, без user_id (так вызывает Application.shutdown), все изменённые.
+        Если запись не удалась, сессия остаётся и будет записана после следующего апдейта."""
+        if user_id is None:
+            user_ids = list(self._dirty)
+        else:
+            user_ids = [user_id] if user_id in self._dirty else []
+        if user_ids:
+            async with self.pool.connection() as conn:
+                await conn.execute(
+                    "INSERT INTO bot_sessions (user_id, data) "
+                    "SELECT * FROM unnest(%s::bigint[], %s::jsonb[]) "
+                    "ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = CURRENT_TIMESTAMP",
+                    (user_ids, [json.dumps(self._session(uid)) for uid in user_ids]))
+                await conn.commit()
+            self._dirty.difference_update(user_ids)
+        for uid in user_ids if user_id is None else [user_id]:
+            self._sessions.pop(uid, None)
+            self._words.pop(uid, None)
+            if self.word_cache:
+                self.word_cache.invalidate(uid)
+
 # Обработчики команд
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(
@@ -46,31 +916,102 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         '*/bulk_add* - добавить много слов (текст или файл)\n'
         '*/edit <id>* - редактировать слово по ID\n'
         '*/delete <id>* - удалить слово по ID\n'
-        '*/test* - пройти тест\n'
+        '*/test [due|errors|stale|random]* - пройти тест\n'
+        '*/quiz [due|errors|stale|random]* - тест с вариантами ответа\n'
+        '*/due* - сколько слов пора повторить\n'
         '*/thesaurus* - показать базу слов\n'
-        '*/stats* - топ-10 ошибок\n'
-        '*/memory* - степень запоминания',
+        '*/search <текст>* - найти слово или перевод\n'
+        '*/stats [дни]* - топ-10 ошибок (за всё время или за период)\n'
+        '*/memory* - степень запоминания\n'
+        '*/export* - выгрузить словарь в файл .tsv',
         parse_mode='Markdown')
 
-async def thesaurus(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not context.bot_data.get('db_pool'):
-        await update.message.reply_text("❌ База данных не подключена!")
-        return
-
-    async with context.bot_data['db_pool'].connection() as conn:
+async def fetch_thesaurus_page(pool, user_id, after_id=0, before_id=None):
+    """Keyset-пагинация по индексу (user_id, id): один индексный запрос на страницу."""
+    async with pool.connection() as conn:
         async with conn.cursor() as c:
-            await c.execute("SELECT id, portuguese, russian FROM thesaurus")
-            words = await c.fetchall()
+            if before_id is None:
+                await c.execute(
+                    "SELECT id, portuguese, russian FROM thesaurus WHERE user_id = %s AND id > %s "
+                    "ORDER BY id LIMIT %s",
+                    (user_id, after_id, THESAURUS_FETCH_LIMIT))
+                return await c.fetchall()
+            await c.execute(
+                "SELECT id, portuguese, russian FROM thesaurus WHERE user_id = %s AND id < %s "
+                "ORDER BY id DESC LIMIT %s",
+                (user_id, before_id, THESAURUS_FETCH_LIMIT))
+            return await c.fetchall()
+
+def render_thesaurus_page(rows):
+    """Набирает строки, пока сообщение вместе с заголовком помещается в лимит."""
+    lines = []
+    length = len(THESAURUS_HEADER)
+    for id, portuguese, russian in rows:
+        line = f"`{id}` | `{portuguese}` | `{russian}`\n"
+        if lines and length + len(line) > MESSAGE_LIMIT:
+            break
+        lines.append(line)
+        length += len(line)
+    return lines
+
+def thesaurus_keyboard(first_id, last_id, has_prev, has_next):
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton('⬅️ Назад', callback_data=f'thesaurus:prev:{first_id}'))
+    if has_next:
+        buttons.append(InlineKeyboardButton('Вперёд ➡️', callback_data=f'thesaurus:next:{last_id}'))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def build_thesaurus_page(context, user_id, after_id=0, before_id=None):
+    """Возвращает (текст, клавиатура) для страницы или (None, None), если строк нет."""
+    rows = await context.bot_data['word_cache'].get(
+        user_id, ('thesaurus', after_id, before_id),
+        lambda: fetch_thesaurus_page(context.bot_data['db_pool'], user_id, after_id, before_id))
+    if not rows:
+        return None, None
+
+    more = len(rows) == THESAURUS_FETCH_LIMIT
+    lines = render_thesaurus_page(rows)
+    more = more or len(lines) < len(rows)
+    page = rows[:len(lines)]
+    if before_id is None:
+        has_prev, has_next = after_id > 0, more
+    else:
+        # Назад читаем в обратном порядке: ближайшие к курсору строки идут первыми
+        page.reverse()
+        lines.reverse()
+        has_prev, has_next = more, True
 
-    if not words:
+    text = THESAURUS_HEADER + ''.join(lines)
+    return text, thesaurus_keyboard(page[0][0], page[-1][0], has_prev, has_next)
+
+@requires_db
+async def thesaurus(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    text, keyboard = await build_thesaurus_page(context, update.effective_user.id)
+
+    if text is None:
         await update.message.reply_text(
             'Тезаурус пуст. Добавь слова с */add*! 📝', parse_mode='Markdown')
         return
 
-    response = "📖 *Тезаурус:*\n\n`ID | Португальский | Русский`\n" + "-" * 40 + "\n"
-    for id, portuguese, russian in words:
-        response += f"`{id}` | `{portuguese}` | `{russian}`\n"
-    await update.message.reply_text(response, parse_mode='Markdown')
+    await update.message.reply_text(text, parse_mode='Markdown', reply_markup=keyboard)
+
+async def thesaurus_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    _, direction, cursor = query.data.split(':')
+    cursor = int(cursor)
+
+    if direction == 'next':
+        text, keyboard = await build_thesaurus_page(context, update.effective_user.id, after_id=cursor)
+    else:
+        text, keyboard = await build_thesaurus_page(context, update.effective_user.id, before_id=cursor)
+
+    if text is None:
+        await query.answer('Больше слов нет')
+        return
+
+    await query.answer()
+    await query.edit_message_text(text, parse_mode='Markdown', reply_markup=keyboard)
 
 async def add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text('🇵🇹 Введи слово на португальском:')
@@ -81,20 +1022,30 @@ async def get_portuguese(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text('🇷🇺 Теперь введи перевод на русский:')
     return RUSSIAN
 
+@requires_db
 async def get_russian(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not context.bot_data.get('db_pool'):
-        await update.message.reply_text("❌ База данных не подключена!")
-        return ConversationHandler.END
-
     russian = update.message.text
     portuguese = context.user_data['portuguese']
 
     async with context.bot_data['db_pool'].connection() as conn:
         async with conn.cursor() as c:
             await c.execute(
-                "INSERT INTO thesaurus (portuguese, russian) VALUES (%s, %s)",
-                (portuguese, russian))
+                "WITH t AS ("
+                "  INSERT INTO thesaurus (user_id, portuguese, russian) VALUES (%s, %s, %s) " + ON_CONFLICT_SKIP +
+                "  RETURNING id, user_id"
+                ") INSERT INTO stats (id, user_id) SELECT id, user_id FROM t",
+                (update.effective_user.id, portuguese, russian))
+            inserted = c.rowcount
+            if inserted:
+                await bump_vocab_version(c, update.effective_user.id)
             await conn.commit()
+    context.bot_data['word_cache'].invalidate(update.effective_user.id)
+
+    if not inserted:
+        await update.message.reply_text(
+            f'⚠️ Слово *"{portuguese}"* с переводом *"{russian}"* уже есть в тезаурусе!',
+            parse_mode='Markdown')
+        return ConversationHandler.END
 
     await update.message.reply_text(
         f'✅ Слово *"{portuguese}"* с переводом *"{russian}"* добавлено!',
@@ -104,121 +1055,206 @@ async def get_russian(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 async def bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text(
         '📋 Отправь текст или файл (.txt) в формате "португальское слово - перевод" (каждая пара на новой строке), например:\n'
-        '`Sol - Солнце\nCasa - Дом`')
+        '`Sol - Солнце\nCasa - Дом`\n'
+        'Файл .tsv из /export тоже подойдёт.')
     return BULK_ADD
 
-async def process_bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not context.bot_data.get('db_pool'):
-        await update.message.reply_text("❌ База данных не подключена!")
-        return ConversationHandler.END
-
+def detect_encoding(data):
+    """Проверяет кодировки по очереди, декодируя данные блоками без копии всего текста."""
+    for encoding in BULK_ENCODINGS:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            for start in range(0, len(data), DECODE_CHUNK_SIZE):
+                decoder.decode(data[start:start + DECODE_CHUNK_SIZE])
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            continue
+        return encoding
+    return None
+
+def iter_lines(data, encoding):
+    """Отдаёт строки файла по одной, декодируя их прямо из data без копии всего файла.
+    В utf-8 и windows-1251 байт перевода строки не встречается внутри символа."""
+    with memoryview(data) as view:
+        start = 0
+        while start < len(data):
+            end = data.find(b'\n', start)
+            if end == -1:
+                end = len(data)
+            yield str(view[start:end], encoding)
+            start = end + 1
+
+def parse_bulk_lines(lines, tsv=False):
+    """Разбирает строки "слово - перевод", а с tsv=True - строки файла .tsv из /export
+    (заголовок пропускается); для некорректных строк отдаёт None."""
+    for line in lines:
+        line = line.strip()
+        if tsv and line:
+            # /export пишет CSV с табуляцией: поля с кавычками или табуляцией взяты в кавычки
+            fields = next(csv.reader([line], delimiter='\t'))
+            if len(fields) < 2:
+                yield None
+                continue
+            if fields[:2] == list(EXPORT_COLUMNS[:2]):
+                continue
+            portuguese, russian = fields[0].strip(), fields[1].strip()
+            # "casa<TAB>-<TAB>дом" - это формат через дефис, набранный с табуляцией
+            if russian == '-':
+                yield None
+                continue
+        elif not line or '-' not in line:
+            yield None
+            continue
+        else:
+            portuguese, russian = [part.strip() for part in line.split('-', 1)]
+        if portuguese and russian:
+            yield portuguese, russian
+        else:
+            yield None
+
+async def copy_bulk_rows(conn, user_id, rows, on_progress=None):
+    """Загружает пары пачками через COPY во временную таблицу и переносит их в тезаурус
+    без дубликатов. Возвращает (added, skipped, errors).
+
+    on_progress - обычная функция, её вызывают не чаще BULK_PROGRESS_INTERVAL секунд.
+    Она не должна ждать Telegram: транзакция COPY в это время открыта."""
     added = 0
+    skipped = 0
     errors = 0
+    batch = []
+    progress_at = time.monotonic()
 
-    async with context.bot_data['db_pool'].connection() as conn:
+    async def flush():
+        nonlocal added, skipped
         async with conn.cursor() as c:
-            try:
-                if update.message.document:
-                    file = await update.message.document.get_file()
-                    file_name = update.message.document.file_name
-                    await update.message.reply_text(
-                        f'📥 Получен файл: {file_name}. Обрабатываю...')
-
-                    if not file_name.endswith('.txt'):
-                        await update.message.reply_text(
-                            '❌ Поддерживаются только файлы .txt!')
-                        return ConversationHandler.END
-
-                    file_path = f"temp_{update.message.document.file_id}.txt"
-                    await file.download_to_drive(custom_path=file_path)
-
-                    lines = None
-                    for encoding in ['utf-8', 'windows-1251']:
-                        try:
-                            with open(file_path, 'r', encoding=encoding) as f:
-                                lines = f.readlines()
-                            break
-                        except UnicodeDecodeError:
-                            continue
-
-                    if lines is None:
-                        with open(file_path, 'rb') as f:
-                            raw_content = f.read().decode('utf-8', errors='replace')
-                        os.remove(file_path)
-                        await update.message.reply_text(
-                            f'❌ Не удалось декодировать файл. Содержимое:\n```{raw_content}```',
-                            parse_mode='Markdown')
-                        return ConversationHandler.END
-
-                    for line in lines:
-                        line = line.strip()
-                        if not line or '-' not in line:
-                            errors += 1
-                            continue
-                        try:
-                            portuguese, russian = [part.strip() for part in line.split('-', 1)]
-                            if portuguese and russian:
-                                await c.execute(
-                                    "INSERT INTO thesaurus (portuguese, russian) VALUES (%s, %s)",
-                                    (portuguese, russian))
-                                added += 1
-                            else:
-                                errors += 1
-                        except Exception:
-                            errors += 1
-
-                    os.remove(file_path)
-                    response = f'✅ Из файла добавлено *{added}* слов!'
-                    if errors > 0:
-                        response += f'\n⚠️ Пропущено строк с ошибками: {errors}'
-                    await update.message.reply_text(response, parse_mode='Markdown')
+            async with c.copy("COPY bulk_import (portuguese, russian) FROM STDIN") as copy:
+                for row in batch:
+                    await copy.write_row(row)
+            await c.execute(
+                "WITH t AS ("
+                "  INSERT INTO thesaurus (user_id, portuguese, russian) "
+                "  SELECT %s, portuguese, russian FROM bulk_import " + ON_CONFLICT_SKIP +
+                "  RETURNING id, user_id"
+                ") INSERT INTO stats (id, user_id) SELECT id, user_id FROM t",
+                (user_id,))
+            added += c.rowcount
+            skipped += len(batch) - c.rowcount
+            await c.execute("TRUNCATE bulk_import")
+        batch.clear()
+
+    await conn.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS bulk_import (portuguese TEXT, russian TEXT) ON COMMIT DROP")
+    for row in rows:
+        if row is None:
+            errors += 1
+            continue
+        batch.append(row)
+        if len(batch) >= BULK_BATCH_SIZE:
+            await flush()
+            if on_progress and time.monotonic() - progress_at >= BULK_PROGRESS_INTERVAL:
+                progress_at = time.monotonic()
+                on_progress(added, skipped, errors)
+    if batch:
+        await flush()
+    if added:
+        async with conn.cursor() as c:
+            await bump_vocab_version(c, user_id)
+    await conn.commit()
+    return added, skipped, errors
+
+def bulk_summary(source, added, skipped, errors):
+    response = f'✅ Из {source} добавлено *{added}* слов!'
+    if skipped > 0:
+        response += f'\n♻️ Пропущено дубликатов: {skipped}'
+    if errors > 0:
+        response += f'\n⚠️ Пропущено строк с ошибками: {errors}'
+    return response
+
+@requires_db
+async def process_bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        if update.message.document:
+            file_name = update.message.document.file_name
+            if not file_name.endswith(('.txt', '.tsv')):
+                await update.message.reply_text(
+                    '❌ Поддерживаются только файлы .txt и .tsv!')
+                return ConversationHandler.END
 
-                else:
-                    text = update.message.text
-                    for line in text.split('\n'):
-                        line = line.strip()
-                        if not line or '-' not in line:
-                            errors += 1
-                            continue
-                        try:
-                            portuguese, russian = [part.strip() for part in line.split('-', 1)]
-                            if portuguese and russian:
-                                await c.execute(
-                                    "INSERT INTO thesaurus (portuguese, russian) VALUES (%s, %s)",
-                                    (portuguese, russian))
-                                added += 1
-                            else:
-                                errors += 1
-                        except Exception:
-                            errors += 1
-
-                    response = f'✅ Из текста добавлено *{added}* слов!'
-                    if errors > 0:
-                        response += f'\n⚠️ Пропущено строк с ошибками: {errors}'
-                    await update.message.reply_text(response, parse_mode='Markdown')
+            # Одно сообщение о статусе, которое редактируется по мере загрузки
+            status = await update.message.reply_text(
+                f'📥 Получен файл: {file_name}. Обрабатываю...')
 
-                await conn.commit()
+            file = await update.message.document.get_file()
+            data = await file.download_as_bytearray()
+
+            encoding = detect_encoding(data)
+            if encoding is None:
+                raw_content = data.decode('utf-8', errors='replace')
+                await status.edit_text(
+                    f'❌ Не удалось декодировать файл. Содержимое:\n```{raw_content}```',
+                    parse_mode='Markdown')
+                return ConversationHandler.END
+
+            # Правка статуса уходит в фоне, пока COPY продолжается; если прошлая ещё
+            # не отправлена, новая пропускается
+            progress = None
 
-            except Exception as e:
-                await update.message.reply_text(f'❌ Ошибка при обработке: {str(e)}')
+            def report_progress(added, skipped, errors):
+                nonlocal progress
+                if progress and not progress.done():
+                    return
+                progress = asyncio.create_task(status.edit_text(
+                    f'📥 {file_name}: добавлено {added} слов, дубликатов: {skipped}, '
+                    f'строк с ошибками: {errors}...'))
+
+            rows = parse_bulk_lines(iter_lines(data, encoding), tsv=file_name.endswith('.tsv'))
+            try:
+                async with context.bot_data['db_pool'].connection() as conn:
+                    added, skipped, errors = await copy_bulk_rows(
+                        conn, update.effective_user.id, rows, report_progress)
+            finally:
+                # Итог не должен обогнать последнюю правку прогресса
+                if progress:
+                    await asyncio.gather(progress, return_exceptions=True)
+            context.bot_data['word_cache'].invalidate(update.effective_user.id)
+
+            await status.edit_text(
+                bulk_summary('файла', added, skipped, errors), parse_mode='Markdown')
+
+        else:
+            text = update.message.text
+            async with context.bot_data['db_pool'].connection() as conn:
+                added, skipped, errors = await copy_bulk_rows(
+                    conn, update.effective_user.id, parse_bulk_lines(text.split('\n')))
+            context.bot_data['word_cache'].invalidate(update.effective_user.id)
+
+            await update.message.reply_text(
+                bulk_summary('текста', added, skipped, errors), parse_mode='Markdown')
+
+    except Exception as e:
+        await update.message.reply_text(f'❌ Ошибка при обработке: {str(e)}')
 
     return ConversationHandler.END
 
+@requires_db
 async def edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not context.bot_data.get('db_pool'):
-        await update.message.reply_text("❌ База данных не подключена!")
-        return ConversationHandler.END
-
     if not context.args:
         await update.message.reply_text(
             '❌ Укажи ID слова! Например: `/edit 1`', parse_mode='Markdown')
         return ConversationHandler.END
 
     word_id = context.args[0]
-    async with context.bot_data['db_pool'].connection() as conn:
-        async with conn.cursor() as c:
-            await c.execute("SELECT portuguese, russian FROM thesaurus WHERE id = %s", (word_id,))
-            word = await c.fetchone()
+    user_id = update.effective_user.id
+
+    async def load_word():
+        async with context.bot_data['db_pool'].connection() as conn:
+            async with conn.cursor() as c:
+                await c.execute(
+                    "SELECT portuguese, russian FROM thesaurus WHERE id = %s AND user_id = %s",
+                    (word_id, user_id))
+                return await c.fetchone()
+
+    word = await context.bot_data['word_cache'].get(user_id, ('word', word_id), load_word)
 
     if not word:
         await update.message.reply_text(
@@ -249,149 +1285,403 @@ async def edit_russian(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
     async with context.bot_data['db_pool'].connection() as conn:
         async with conn.cursor() as c:
-            await c.execute(
-                "UPDATE thesaurus SET portuguese = %s, russian = %s WHERE id = %s",
-                (new_portuguese, new_russian, word_id))
-            await conn.commit()
+            try:
+                await c.execute(
+                    "UPDATE thesaurus SET portuguese = %s, russian = %s WHERE id = %s AND user_id = %s",
+                    (new_portuguese, new_russian, word_id, update.effective_user.id))
+                if c.rowcount:
+                    await bump_vocab_version(c, update.effective_user.id)
+                await conn.commit()
+            except UniqueViolation:
+                await conn.rollback()
+                await update.message.reply_text(
+                    f'⚠️ Пара *{new_portuguese} - {new_russian}* уже есть в тезаурусе!',
+                    parse_mode='Markdown')
+                return ConversationHandler.END
+    context.bot_data['word_cache'].invalidate(update.effective_user.id)
 
     await update.message.reply_text(
         f'✅ Слово с ID {word_id} обновлено: *{new_portuguese} - {new_russian}*',
         parse_mode='Markdown')
     return ConversationHandler.END
 
+@requires_db
 async def delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not context.bot_data.get('db_pool'):
-        await update.message.reply_text("❌ База данных не подключена!")
-        return
-
     if not context.args:
         await update.message.reply_text(
             '❌ Укажи ID слова! Например: `/delete 1`', parse_mode='Markdown')
         return
 
     word_id = context.args[0]
+    # stats, history и history_daily удаляются каскадом
     async with context.bot_data['db_pool'].connection() as conn:
         async with conn.cursor() as c:
-            await c.execute("SELECT portuguese, russian FROM thesaurus WHERE id = %s", (word_id,))
+            await c.execute(
+                "DELETE FROM thesaurus WHERE id = %s AND user_id = %s RETURNING portuguese, russian",
+                (word_id, update.effective_user.id))
             word = await c.fetchone()
-
-            if not word:
-                await update.message.reply_text(
-                    f'❌ Слово с ID {word_id} не найдено! Проверь */thesaurus*',
-                    parse_mode='Markdown')
-                return
-
-            await c.execute("DELETE FROM thesaurus WHERE id = %s", (word_id,))
-            await c.execute("DELETE FROM stats WHERE id = %s", (word_id,))
-            await c.execute("DELETE FROM history WHERE word_id = %s", (word_id,))
+            if word:
+                await bump_vocab_version(c, update.effective_user.id)
             await conn.commit()
+    context.bot_data['word_cache'].invalidate(update.effective_user.id)
+
+    if not word:
+        await update.message.reply_text(
+            f'❌ Слово с ID {word_id} не найдено! Проверь */thesaurus*',
+            parse_mode='Markdown')
+        return
 
     await update.message.reply_text(
         f'🗑️ Слово *{word[0]} - {word[1]}* (ID {word_id}) удалено!',
         parse_mode='Markdown')
 
-async def test(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not context.bot_data.get('db_pool'):
-        await update.message.reply_text("❌ База данных не подключена!")
-        return ConversationHandler.END
+async def select_due(c, user_id, limit):
+    """Слова, срок повторения которых наступил, по индексу stats(user_id, due_at)."""
+    await c.execute(
+        "SELECT t.id, t.portuguese, t.russian FROM ("
+        "  SELECT id FROM stats WHERE user_id = %s AND due_at <= CURRENT_TIMESTAMP ORDER BY due_at LIMIT %s"
+        ") s JOIN thesaurus t ON t.id = s.id",
+        (user_id, limit))
+    return await c.fetchall()
+
+async def select_by_errors(c, user_id, limit):
+    """Слова с наибольшим числом ошибок; равные перемешиваются среди первых кандидатов."""
+    await c.execute(
+        "SELECT t.id, t.portuguese, t.russian FROM ("
+        "  SELECT id, incorrect FROM stats WHERE user_id = %s ORDER BY incorrect DESC LIMIT %s"
+        ") s JOIN thesaurus t ON t.id = s.id "
+        "ORDER BY s.incorrect DESC, random() LIMIT %s",
+        (user_id, TEST_CANDIDATES, limit))
+    return await c.fetchall()
+
+async def select_stale(c, user_id, limit):
+    """Слова, которые дольше всего не попадались в тесте; новые идут первыми."""
+    await c.execute(
+        "SELECT t.id, t.portuguese, t.russian FROM ("
+        "  SELECT id FROM stats WHERE user_id = %s ORDER BY last_seen NULLS FIRST LIMIT %s"
+        ") s JOIN thesaurus t ON t.id = s.id",
+        (user_id, limit))
+    return await c.fetchall()
+
+async def select_random(c, user_id, limit):
+    """Случайная выборка пробами по индексу (user_id, id): для каждой пробы берётся
+    случайная точка в диапазоне id пользователя и первое его слово после неё.
+    Читаются только строки этого пользователя, около 2 * limit на запрос."""
+    await c.execute(
+        "WITH bounds AS (SELECT MIN(id) AS lo, MAX(id) AS hi FROM thesaurus WHERE user_id = %s), "
+        "probes AS ("
+        "  SELECT lo + floor(random() * (hi - lo + 1))::bigint AS start "
+        "  FROM bounds, generate_series(1, %s) WHERE lo IS NOT NULL"
+        ") "
+        "SELECT id, portuguese, russian FROM ("
+        "  SELECT DISTINCT w.id, w.portuguese, w.russian FROM probes, LATERAL ("
+        "    SELECT id, portuguese, russian FROM thesaurus "
+        "    WHERE user_id = %s AND id >= probes.start ORDER BY id LIMIT 1"
+        "  ) w"
+        ") s ORDER BY random() LIMIT %s",
+        (user_id, 2 * limit, user_id, limit))
+    words = await c.fetchall()
+    if len(words) < limit:
+        # Маленький словарь или совпавшие пробы - перемешиваем все слова пользователя
+        await c.execute(
+            "SELECT id, portuguese, russian FROM thesaurus WHERE user_id = %s ORDER BY random() LIMIT %s",
+            (user_id, limit))
+        words = await c.fetchall()
+    return words
+
+# Стратегии выбора слов для /test: каждая - один ограниченный по LIMIT запрос
+TEST_STRATEGIES = {
+    'due': select_due,
+    'errors': select_by_errors,
+    'stale': select_stale,
+    'random': select_random,
+}
+
+async def start_test(update: Update, context: ContextTypes.DEFAULT_TYPE, quiz=False) -> bool:
+    """Выбирает слова теста по стратегии из аргументов команды и сохраняет их в user_data.
+    Для теста с вариантами тем же соединением выбирается запас слов для неправильных
+    вариантов. Возвращает False, если тест начать нельзя (об этом уже сообщено)."""
+    command = 'quiz' if quiz else 'test'
+    strategy = context.args[0] if context.args else 'due'
+    if strategy not in TEST_STRATEGIES:
+        await update.message.reply_text(
+            f'❌ Неизвестный режим теста! Доступны: `{", ".join(TEST_STRATEGIES)}`',
+            parse_mode='Markdown')
+        return False
 
+    user_id = update.effective_user.id
+    next_due = None
+    pool = []
     async with context.bot_data['db_pool'].connection() as conn:
         async with conn.cursor() as c:
-            await c.execute(
-                "SELECT t.id, t.portuguese, t.russian, COALESCE(s.incorrect, 0) as errors FROM thesaurus t "
-                "LEFT JOIN stats s ON t.id = s.id")
-            words = await c.fetchall()
+            test_words = await TEST_STRATEGIES[strategy](c, user_id, TEST_SIZE)
+            if not test_words and strategy == 'due':
+                await c.execute("SELECT MIN(due_at) FROM stats WHERE user_id = %s", (user_id,))
+                next_due = (await c.fetchone())[0]
+            if test_words and quiz:
+                pool = await select_random(c, user_id, QUIZ_POOL_SIZE)
+
+    if next_due:
+        await update.message.reply_text(
+            f'😌 Сейчас нечего повторять! Следующее слово: *{next_due:%d.%m %H:%M}*.\n'
+            f'Можно пройти тест по ошибкам: */{command} errors*',
+            parse_mode='Markdown')
+        return False
 
-    if not words:
+    if not test_words:
         await update.message.reply_text(
             'Тезаурус пуст. Добавь слова с */add*! 📝', parse_mode='Markdown')
-        return ConversationHandler.END
+        return False
 
-    sorted_words = sorted(words, key=lambda x: x[3], reverse=True)
-    test_words = sorted_words[:min(25, len(words))]
     random.shuffle(test_words)
     context.user_data['test_words'] = test_words
     context.user_data['test_index'] = 0
     context.user_data['test_direction'] = [
         random.choice(['pt_to_ru', 'ru_to_pt']) for _ in test_words
     ]
+    context.user_data.pop('quiz_pool', None)
+    context.user_data.pop('quiz_options', None)
+    if quiz:
+        context.user_data['quiz_pool'] = [[portuguese, russian] for _, portuguese, russian in pool]
+    return True
+
+@requires_db
+async def test(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if not await start_test(update, context):
+        return ConversationHandler.END
 
     await ask_question(update, context)
     return TEST_ANSWER
 
-async def ask_question(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def next_question(context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Готовит текущий вопрос теста: запоминает правильный ответ и возвращает текст."""
     index = context.user_data['test_index']
-    word_id, portuguese, russian, _ = context.user_data['test_words'][index]
+    word_id, portuguese, russian = context.user_data['test_words'][index]
     direction = context.user_data['test_direction'][index]
     total = len(context.user_data['test_words'])
 
     if direction == 'pt_to_ru':
-        await update.message.reply_text(
-            f'❓ *Вопрос {index + 1} из {total}:* Переведи *{portuguese}*',
-            parse_mode='Markdown')
         context.user_data['correct_answer'] = russian
+        question = portuguese
     else:
-        await update.message.reply_text(
-            f'❓ *Вопрос {index + 1} из {total}:* Переведи *{russian}*',
-            parse_mode='Markdown')
         context.user_data['correct_answer'] = portuguese
+        question = russian
     context.user_data['current_word_id'] = word_id
+    return f'❓ *Вопрос {index + 1} из {total}:* Переведи *{question}*'
+
+async def ask_question(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(next_question(context), parse_mode='Markdown')
+
+# Новый интервал SM-2 в днях: 1, 6, затем предыдущий интервал, умноженный на лёгкость.
+# В SET все выражения видят значения строки до обновления
+SRS_NEXT_INTERVAL = (
+    "CASE WHEN %(correct)s = 0 THEN 0 "
+    "     WHEN repetitions = 0 THEN 1 "
+    "     WHEN repetitions = 1 THEN 6 "
+    "     ELSE interval_days * ease END")
+
+async def record_answer(pool, user_id, word_id, is_correct):
+    """Обновляет stats вместе с расписанием повторений, дневные итоги и history одним оператором;
+    в режиме pipeline BEGIN, запрос и COMMIT уходят в базу за один сетевой обмен."""
+    async with pool.connection() as conn:
+        async with conn.pipeline():
+            await conn.execute(
+                "WITH s AS ("
+                "  UPDATE stats SET correct = correct + %(correct)s, "
+                "                   incorrect = incorrect + 1 - %(correct)s, "
+                "                   last_seen = CURRENT_TIMESTAMP, "
+                "                   repetitions = CASE WHEN %(correct)s = 1 THEN repetitions + 1 ELSE 0 END, "
+                "                   ease = CASE WHEN %(correct)s = 1 THEN ease + %(bonus)s "
+                "                               ELSE GREATEST(%(min_ease)s, ease - %(penalty)s) END, "
+                "                   interval_days = " + SRS_NEXT_INTERVAL + ", "
+                "                   due_at = CURRENT_TIMESTAMP + CASE WHEN %(correct)s = 1 "
+                "                       THEN (" + SRS_NEXT_INTERVAL + ") * INTERVAL '1 day' "
+                "                       ELSE %(relearn)s * INTERVAL '1 minute' END "
+                "  WHERE id = %(id)s"
+                "), d AS ("
+                "  INSERT INTO history_daily (word_id, user_id, day, correct, incorrect) "
+                "  VALUES (%(id)s, %(user_id)s, CURRENT_DATE, %(correct)s, 1 - %(correct)s) "
+                "  ON CONFLICT (word_id, day) DO UPDATE SET "
+                "      correct = history_daily.correct + EXCLUDED.correct, "
+                "      incorrect = history_daily.incorrect + EXCLUDED.incorrect"
+                ") INSERT INTO history (word_id, user_id, correct) VALUES (%(id)s, %(user_id)s, %(correct)s)",
+                {'id': word_id, 'user_id': user_id, 'correct': int(is_correct), 'bonus': SRS_EASE_BONUS,
+                 'penalty': SRS_EASE_PENALTY, 'min_ease': SRS_MIN_EASE, 'relearn': SRS_RELEARN_MINUTES})
+            await conn.commit()
+
+def fold_word(word):
+    """Нижний регистр без диакритики: "Você" -> "voce", "ёж" -> "еж".
+    Й - отдельная буква, а не и с ударением, поэтому "мой" не становится "мои"."""
+    decomposed = unicodedata.normalize('NFKD', word.strip().lower())
+    folded = []
+    for char in decomposed:
+        if not unicodedata.combining(char) or (char == '\u0306' and folded and folded[-1] == 'и'):
+            folded.append(char)
+    return unicodedata.normalize('NFC', ''.join(folded))
+
+def allowed_typos(word):
+    return 0 if len(word) < TYPO_ONE_LENGTH else 1 if len(word) < TYPO_TWO_LENGTH else 2
+
+def within_distance(a, b, limit):
+    """Проверяет, что расстояние Левенштейна между a и b не больше limit.
+
+    Считается только полоса шириной 2 * limit + 1 вокруг диагонали, и расчёт
+    прекращается, как только все значения в строке превысили limit.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return False
+    beyond = limit + 1
+    previous = [min(j, beyond) for j in range(len(b) + 1)]
+    for i, char in enumerate(a, 1):
+        current = [beyond] * (len(b) + 1)
+        current[0] = min(i, beyond)
+        row_min = current[0]
+        for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != b[j - 1]))
+            row_min = min(row_min, current[j])
+        if row_min > limit:
+            return False
+        previous = current
+    return previous[len(b)] <= limit
+
+def match_answer(answer, correct_answer, other_words=()):
+    """Возвращает (засчитан, написан точно). Без учёта регистра и диакритики ответ
+    засчитывается с опечатками в пределах allowed_typos, если только он не совпадает
+    с одним из other_words - тогда это другое слово, а не опечатка."""
+    if answer.strip().lower() == correct_answer.strip().lower():
+        return True, True
+    answer, correct = fold_word(answer), fold_word(correct_answer)
+    if answer == correct:
+        return True, False
+    if any(fold_word(word) == answer for word in other_words):
+        return False, False
+    return within_distance(answer, correct, allowed_typos(correct)), False
+
+def grade_answer(context: ContextTypes.DEFAULT_TYPE, is_correct: bool, exact: bool = True):
+    """Вердикт на текущий вопрос и переход к следующему. Возвращает (сообщения, тест окончен)."""
+    correct_answer = context.user_data['correct_answer']
+    if is_correct and not exact:
+        replies = [f'✅ *Почти правильно!* Пишется так: *"{correct_answer}"*']
+    elif is_correct:
+        replies = ['✅ *Перевод правильный!*']
+    else:
+        replies = [f'❌ *Ошибка!* Правильный ответ: *"{correct_answer}"*']
+
+    context.user_data['test_index'] += 1
+    if context.user_data['test_index'] < len(context.user_data['test_words']):
+        replies.append(next_question(context))
+        return replies, False
+    replies.append(
+        '🎉 *Тест завершён!* Хочешь посмотреть статистику? Используй */stats* или */memory*!')
+    return replies, True
 
 async def check_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_answer = update.message.text
     correct_answer = context.user_data['correct_answer']
     word_id = context.user_data['current_word_id']
 
-    async with context.bot_data['db_pool'].connection() as conn:
-        async with conn.cursor() as c:
-            await c.execute(
-                "INSERT INTO stats (id) VALUES (%s) ON CONFLICT (id) DO NOTHING",
-                (word_id,))
-            is_correct = user_answer.lower() == correct_answer.lower()
-
-            if is_correct:
-                await update.message.reply_text('✅ *Перевод правильный!*',
-                                                parse_mode='Markdown')
-                await c.execute(
-                    "UPDATE stats SET correct = correct + 1 WHERE id = %s",
-                    (word_id,))
-                await c.execute(
-                    "INSERT INTO history (word_id, correct) VALUES (%s, 1)",
-                    (word_id,))
-            else:
-                await update.message.reply_text(
-                    f'❌ *Ошибка!* Правильный ответ: *"{correct_answer}"*',
-                    parse_mode='Markdown')
-                await c.execute(
-                    "UPDATE stats SET incorrect = incorrect + 1 WHERE id = %s",
-                    (word_id,))
-                await c.execute(
-                    "INSERT INTO history (word_id, correct) VALUES (%s, 0)",
-                    (word_id,))
+    # Слова текущего теста уже в памяти: ответ другим из них не считается опечаткой
+    other_words = [word for test_word in context.user_data['test_words'] for word in test_word[1:]]
+    is_correct, exact = match_answer(user_answer, correct_answer, other_words)
+    replies, finished = grade_answer(context, is_correct, exact)
+    next_state = ConversationHandler.END if finished else TEST_ANSWER
+
+    async def send_replies():
+        # Вердикт и следующий вопрос уходят одним сообщением; если не поместились -
+        # по очереди, чтобы вердикт не оказался после вопроса
+        for reply in coalesce(replies):
+            await update.message.reply_text(reply, parse_mode='Markdown')
+
+    # Запись ответа не держит соединение из пула на время обращений к Telegram
+    await asyncio.gather(
+        record_answer(context.bot_data['db_pool'], update.effective_user.id, word_id, is_correct),
+        send_replies())
+    return next_state
+
+def quiz_keyboard(context: ContextTypes.DEFAULT_TYPE):
+    """Варианты для текущего вопроса: правильный ответ и случайные переводы из запаса
+    и других слов теста в том же направлении."""
+    correct_answer = context.user_data['correct_answer']
+    index = context.user_data['test_index']
+    # 1 - русский перевод, 0 - португальское слово
+    side = 1 if context.user_data['test_direction'][index] == 'pt_to_ru' else 0
+    candidates = {pair[side] for pair in context.user_data['quiz_pool']}
+    candidates.update(word[side + 1] for word in context.user_data['test_words'])
+    candidates = sorted(c for c in candidates if c.lower() != correct_answer.lower())
+
+    options = random.sample(candidates, min(QUIZ_OPTIONS - 1, len(candidates))) + [correct_answer]
+    random.shuffle(options)
+    context.user_data['quiz_options'] = options
+    word_id = context.user_data['current_word_id']
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(option, callback_data=f'quiz:{word_id}:{i}')]
+        for i, option in enumerate(options)
+    ])
+
+@requires_db
+async def quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if await start_test(update, context, quiz=True):
+        await update.message.reply_text(
+            next_question(context), parse_mode='Markdown', reply_markup=quiz_keyboard(context))
+    # Текстовый тест, если он шёл, завершается: ответы теперь приходят кнопками
+    return ConversationHandler.END
 
-            await conn.commit()
+async def quiz_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    _, word_id, option = query.data.split(':')
+    options = context.user_data.get('quiz_options')
+    if not options or context.user_data.get('current_word_id') != int(word_id) or int(option) >= len(options):
+        await query.answer('Этот вопрос уже закрыт')
+        return
 
-    context.user_data['test_index'] += 1
-    if context.user_data['test_index'] < len(context.user_data['test_words']):
-        await ask_question(update, context)
-        return TEST_ANSWER
+    is_correct = options[int(option)] == context.user_data['correct_answer']
+    replies, finished = grade_answer(context, is_correct)
+    keyboard = None
+    if finished:
+        context.user_data.pop('quiz_pool', None)
+        context.user_data.pop('quiz_options', None)
     else:
-        await update.message.reply_text(
-            '🎉 *Тест завершён!* Хочешь посмотреть статистику? Используй */stats* или */memory*!',
-            parse_mode='Markdown')
-        return ConversationHandler.END
+        keyboard = quiz_keyboard(context)
 
+    async def show_next():
+        # Вердикт и следующий вопрос заменяют прежний вопрос в том же сообщении
+        await query.answer('✅' if is_correct else '❌')
+        await query.edit_message_text('\n\n'.join(replies), parse_mode='Markdown', reply_markup=keyboard)
+
+    await asyncio.gather(
+        record_answer(context.bot_data['db_pool'], update.effective_user.id, int(word_id), is_correct),
+        show_next())
+
+@requires_db
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not context.bot_data.get('db_pool'):
-        await update.message.reply_text("❌ База данных не подключена!")
-        return
+    days = None
+    if context.args:
+        if not context.args[0].isdigit() or not 1 <= int(context.args[0]) <= STATS_MAX_DAYS:
+            await update.message.reply_text(
+                f'❌ Укажи период в днях от 1 до {STATS_MAX_DAYS}! Например: `/stats 7`',
+                parse_mode='Markdown')
+            return
+        days = int(context.args[0])
 
     async with context.bot_data['db_pool'].connection() as conn:
         async with conn.cursor() as c:
-            await c.execute(
-                "SELECT t.portuguese, t.russian, COALESCE(s.incorrect, 0) as errors "
-                "FROM thesaurus t LEFT JOIN stats s ON t.id = s.id "
-                "ORDER BY errors DESC LIMIT 10")
+            if days is None:
+                # Топ по индексу stats(user_id, incorrect DESC): читается только STATS_TOP строк
+                await c.execute(
+                    "SELECT t.portuguese, t.russian, s.incorrect FROM ("
+                    "  SELECT id, incorrect FROM stats WHERE user_id = %s ORDER BY incorrect DESC LIMIT %s"
+                    ") s JOIN thesaurus t ON t.id = s.id ORDER BY s.incorrect DESC",
+                    (update.effective_user.id, STATS_TOP))
+            else:
+                # За период суммируем дневные итоги, а не сырую history
+                await c.execute(
+                    "SELECT t.portuguese, t.russian, d.errors FROM ("
+                    "  SELECT word_id, SUM(incorrect) AS errors FROM history_daily "
+                    "  WHERE user_id = %s AND day > CURRENT_DATE - %s "
+                    "  GROUP BY word_id HAVING SUM(incorrect) > 0 "
+                    "  ORDER BY errors DESC LIMIT %s"
+                    ") d JOIN thesaurus t ON t.id = d.word_id ORDER BY d.errors DESC",
+                    (update.effective_user.id, days, STATS_TOP))
             top_errors = await c.fetchall()
 
     if not top_errors or all(errors == 0 for _, _, errors in top_errors):
@@ -400,54 +1690,176 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             parse_mode='Markdown')
         return
 
-    response = "📊 *Топ-10 слов с ошибками:*\n\n`Слово | Перевод | Ошибки`\n" + "-" * 40 + "\n"
+    period = f' за {days} дн.' if days else ''
+    response = f"📊 *Топ-{STATS_TOP} слов с ошибками{period}:*\n\n`Слово | Перевод | Ошибки`\n" + "-" * 40 + "\n"
     for portuguese, russian, errors in top_errors:
         response += f"`{portuguese}` | `{russian}` | {errors}\n"
     await update.message.reply_text(response, parse_mode='Markdown')
 
+@requires_db
+async def due(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Каждый подзапрос - диапазон по индексу stats(user_id, due_at) или stats(user_id, last_seen)
+    async with context.bot_data['db_pool'].connection() as conn:
+        async with conn.cursor() as c:
+            await c.execute(
+                "SELECT (SELECT COUNT(*) FROM stats WHERE user_id = %(user_id)s "
+                "        AND due_at <= CURRENT_TIMESTAMP), "
+                "       (SELECT COUNT(*) FROM stats WHERE user_id = %(user_id)s "
+                "        AND due_at <= CURRENT_TIMESTAMP + INTERVAL '1 day'), "
+                "       (SELECT COUNT(*) FROM stats WHERE user_id = %(user_id)s AND last_seen IS NULL), "
+                "       (SELECT MIN(due_at) FROM stats WHERE user_id = %(user_id)s "
+                "        AND due_at > CURRENT_TIMESTAMP)",
+                {'user_id': update.effective_user.id})
+            due_now, due_today, new_words, next_due = await c.fetchone()
+
+    response = (
+        '🗓 *Повторение:*\n\n'
+        f'Готово к повторению: *{due_now}*\n'
+        f'В ближайшие 24 часа: *{due_today}*\n'
+        f'Ещё не встречались в тестах: *{new_words}*')
+    if not due_now and next_due:
+        response += f'\nСледующее слово: *{next_due:%d.%m %H:%M}*'
+    await update.message.reply_text(response, parse_mode='Markdown')
+
+@requires_db
 async def memory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not context.bot_data.get('db_pool'):
-        await update.message.reply_text("❌ База данных не подключена!")
+    # Один запрос: последние MEMORY_WINDOW ответов по каждому слову через оконную функцию
+    async with context.bot_data['db_pool'].connection() as conn:
+        async with conn.cursor() as c:
+            await c.execute(
+                "SELECT t.portuguese, t.russian, r.correct_count FROM thesaurus t "
+                "LEFT JOIN (" + RECENT_CORRECT_SQL + ") r ON r.word_id = t.id "
+                "WHERE t.user_id = %(user_id)s ORDER BY t.id",
+                {'user_id': update.effective_user.id, 'window': MEMORY_WINDOW})
+            words = await c.fetchall()
+
+    rows = [(portuguese, russian, "N/A" if correct_count is None else MEMORY_PERCENT[correct_count])
+            for portuguese, russian, correct_count in words]
+    response = "🧠 *Степень запоминания:*\n\n`Слово | Перевод | %`\n" + "-" * 40 + "\n"
+    response += ''.join(f"`{portuguese}` | `{russian}` | {percent}%\n" for portuguese, russian, percent in rows)
+    if len(response) <= MESSAGE_LIMIT:
+        await update.message.reply_text(response, parse_mode='Markdown')
         return
 
+    # Большой словарь не помещается в одно сообщение - отправляем таблицу файлом
+    lines = ['portuguese\trussian\tmemory\n']
+    lines += [f"{portuguese}\t{russian}\t{percent}\n" for portuguese, russian, percent in rows]
+    document = io.BytesIO(''.join(lines).encode())
+    await update.message.reply_document(
+        document=document, filename='memory.tsv',
+        caption=f'🧠 Степень запоминания для {len(rows)} слов')
+
+@requires_db
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not context.args:
+        await update.message.reply_text(
+            '❌ Укажи, что искать! Например: `/search casa`', parse_mode='Markdown')
+        return
+
+    query = ' '.join(context.args)
+    pattern = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    # Подстрока и похожесть проверяются по триграммным индексам на normalize_word
     async with context.bot_data['db_pool'].connection() as conn:
         async with conn.cursor() as c:
-            await c.execute("SELECT t.portuguese, t.russian, t.id FROM thesaurus t")
-            words = await c.fetchall()
+            await c.execute(
+                "SELECT id, portuguese, russian FROM thesaurus "
+                "WHERE user_id = %(user_id)s AND ("
+                "  normalize_word(portuguese) LIKE '%%' || normalize_word(%(pattern)s) || '%%' "
+                "  OR normalize_word(russian) LIKE '%%' || normalize_word(%(pattern)s) || '%%' "
+                "  OR normalize_word(portuguese) %% normalize_word(%(query)s) "
+                "  OR normalize_word(russian) %% normalize_word(%(query)s)"
+                ") ORDER BY GREATEST("
+                "  similarity(normalize_word(portuguese), normalize_word(%(query)s)), "
+                "  similarity(normalize_word(russian), normalize_word(%(query)s))) DESC, id "
+                "LIMIT %(limit)s",
+                {'user_id': update.effective_user.id, 'query': query, 'pattern': pattern,
+                 'limit': SEARCH_LIMIT})
+            rows = await c.fetchall()
+
+    if not rows:
+        await update.message.reply_text(
+            f'🔎 По запросу *{query}* ничего не найдено', parse_mode='Markdown')
+        return
 
-            response = "🧠 *Степень запоминания:*\n\n`Слово | Перевод | %`\n" + "-" * 40 + "\n"
-            for portuguese, russian, word_id in words:
-                await c.execute(
-                    "SELECT correct FROM history WHERE word_id = %s ORDER BY timestamp DESC LIMIT 5",
-                    (word_id,))
-                last_5 = await c.fetchall()
-                if not last_5:
-                    percent = "N/A"
-                else:
-                    correct_count = sum(1 for (correct,) in last_5 if correct)
-                    percent = {
-                        5: 100,
-                        4: 75,
-                        3: 50,
-                        2: 25,
-                        1: 0,
-                        0: 0
-                    }[correct_count]
-                response += f"`{portuguese}` | `{russian}` | {percent}%\n"
+    await update.message.reply_text(
+        f'🔎 *Найдено по запросу "{query}":*\n\n' + ''.join(render_thesaurus_page(rows)),
+        parse_mode='Markdown')
 
-    await update.message.reply_text(response, parse_mode='Markdown')
+@requires_db
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # COPY отдаёт готовые строки TSV кусками: в памяти только сам файл, без объектов строк.
+    # Формат csv, а не text: text экранирует обратную косую черту, и она удваивалась бы
+    # при каждом экспорте и импорте
+    memory_percent = "CASE r.correct_count " + " ".join(
+        f"WHEN {count} THEN {percent}" for count, percent in MEMORY_PERCENT.items()) + " END"
+    buffer = io.BytesIO()
+    buffer.write(('\t'.join(EXPORT_COLUMNS) + '\n').encode())
+    header_size = buffer.tell()
+    async with context.bot_data['db_pool'].connection() as conn:
+        async with conn.cursor() as c:
+            async with c.copy(
+                "COPY ("
+                "  SELECT t.portuguese, t.russian, s.correct, s.incorrect, "
+                "         " + memory_percent + ", "
+                "         to_char(s.due_at, 'YYYY-MM-DD HH24:MI') "
+                "  FROM thesaurus t JOIN stats s ON s.id = t.id "
+                "  LEFT JOIN (" + RECENT_CORRECT_SQL + ") r ON r.word_id = t.id "
+                "  WHERE t.user_id = %(user_id)s ORDER BY t.id"
+                ") TO STDOUT (FORMAT csv, DELIMITER E'\\t')",
+                {'user_id': update.effective_user.id, 'window': MEMORY_WINDOW}) as copy:
+                async for data in copy:
+                    buffer.write(data)
+
+    if buffer.tell() == header_size:
+        await update.message.reply_text(
+            'Тезаурус пуст. Добавь слова с */add*! 📝', parse_mode='Markdown')
+        return
+
+    words = buffer.getvalue().count(b'\n') - 1
+    buffer.seek(0)
+    await update.message.reply_document(
+        document=buffer, filename='thesaurus.tsv',
+        caption=f'📤 Экспортировано слов: {words}. Файл можно загрузить обратно через /bulk_add')
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text('✋ Операция отменена.')
     return ConversationHandler.END
 
-async def setup_application(db_pool=None):
-    # Создаём приложение
-    application = ApplicationBuilder().token(TOKEN).build()
+def traced(callback):
+    """Записывает имя обработчика в трассировку текущего апдейта."""
+    async def wrapper(update, context):
+        trace = current_trace.get()
+        if trace:
+            trace.handler = callback.__name__
+        return await callback(update, context)
+    return wrapper
+
+def instrument_handlers(application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            nested = [handler]
+            if isinstance(handler, ConversationHandler):
+                nested = [*handler.entry_points, *handler.fallbacks,
+                          *(h for state in handler.states.values() for h in state)]
+            for h in nested:
+                h.callback = traced(h.callback)
+
+def setup_application(db_pool=None):
+    # Создаём приложение; при наличии базы состояние диалогов хранится в ней.
+    # Пул HTTP-соединений бота рассчитан на одновременную обработку апдейтов
+    bot = ServerlessBot(
+        TOKEN, request=TimedRequest(connection_pool_size=UPDATE_CONCURRENCY),
+        rate_limiter=TelegramRateLimiter() if RATE_LIMIT_ENABLED else None)
+    builder = ApplicationBuilder().bot(bot)
+    word_cache = WordCache()
+    if db_pool:
+        builder = builder.persistence(PostgresPersistence(db_pool, word_cache))
+    application = builder.build()
 
-    # Сохраняем пул в bot_data, если он есть
+    # Сохраняем пул и кэш словаря в bot_data, если база есть
     if db_pool:
         application.bot_data['db_pool'] = db_pool
+        application.bot_data['word_cache'] = word_cache
 
     # Добавляем обработчики
     application.add_handler(CommandHandler("start", start))
@@ -455,9 +1867,14 @@ async def setup_application(db_pool=None):
 
     if db_pool:
         application.add_handler(CommandHandler("thesaurus", thesaurus))
+        application.add_handler(CallbackQueryHandler(thesaurus_page, pattern=r'^thesaurus:(next|prev):\d+$'))
         application.add_handler(CommandHandler("stats", stats))
         application.add_handler(CommandHandler("memory", memory))
+        application.add_handler(CommandHandler("export", export))
+        application.add_handler(CommandHandler("search", search))
+        application.add_handler(CommandHandler("due", due))
         application.add_handler(CommandHandler("delete", delete))
+        application.add_handler(CallbackQueryHandler(quiz_answer, pattern=r'^quiz:\d+:\d+$'))
 
         add_handler = ConversationHandler(
             entry_points=[CommandHandler('add', add)],
@@ -465,7 +1882,9 @@ async def setup_application(db_pool=None):
                 PORTUGUESE: [MessageHandler(filters.ALL & ~filters.COMMAND, get_portuguese)],
                 RUSSIAN: [MessageHandler(filters.ALL & ~filters.COMMAND, get_russian)],
             },
-            fallbacks=[CommandHandler('cancel', cancel)]
+            fallbacks=[CommandHandler('cancel', cancel)],
+            name='add',
+            persistent=True
         )
         application.add_handler(add_handler)
 
@@ -474,7 +1893,9 @@ async def setup_application(db_pool=None):
             states={
                 BULK_ADD: [MessageHandler(filters.ALL & ~filters.COMMAND | filters.Document.ALL, process_bulk_add)]
             },
-            fallbacks=[CommandHandler('cancel', cancel)]
+            fallbacks=[CommandHandler('cancel', cancel)],
+            name='bulk_add',
+            persistent=True
         )
         application.add_handler(bulk_handler)
 
@@ -484,34 +1905,87 @@ async def setup_application(db_pool=None):
                 EDIT_PORTUGUESE: [MessageHandler(filters.ALL & ~filters.COMMAND, edit_portuguese)],
                 EDIT_RUSSIAN: [MessageHandler(filters.ALL & ~filters.COMMAND, edit_russian)],
             },
-            fallbacks=[CommandHandler('cancel', cancel)]
+            fallbacks=[CommandHandler('cancel', cancel)],
+            name='edit',
+            persistent=True
         )
         application.add_handler(edit_handler)
 
+        # /quiz обрабатывается этим же диалогом, чтобы прервать текстовый тест, если он идёт
         test_handler = ConversationHandler(
-            entry_points=[CommandHandler('test', test)],
+            entry_points=[CommandHandler('test', test), CommandHandler('quiz', quiz)],
             states={
                 TEST_ANSWER: [MessageHandler(filters.ALL & ~filters.COMMAND, check_answer)]
             },
-            fallbacks=[CommandHandler('cancel', cancel)]
+            fallbacks=[CommandHandler('cancel', cancel), CommandHandler('quiz', quiz)],
+            name='test',
+            persistent=True
         )
         application.add_handler(test_handler)
 
+    instrument_handlers(application)
     return application
 
-# Инициализация базы данных при старте
-db_pool = None
-if DATABASE_URL:
-    try:
-        db_pool = AsyncConnectionPool(DATABASE_URL, min_size=1, max_size=20)
-        asyncio.get_event_loop().run_until_complete(init_db(db_pool))
-        print("Database pool created successfully!")
-    except Exception as e:
-        print(f"Failed to create database pool: {e}")
+# При импорте не ходим ни в сеть, ни в базу: пул открывается при первом запросе,
+# схема обновляется отдельной командой migrate
+db_pool = create_pool() if DATABASE_URL else None
 
 # Настройка приложения
 application = setup_application(db_pool)
-asyncio.get_event_loop().run_until_complete(application.initialize())
+mark_startup('application_built')
+application_lock = asyncio.Lock()
+application_initialized = False
+
+async def ensure_initialized():
+    global application_initialized
+    async with application_lock:
+        if not application_initialized:
+            await application.initialize()
+            application_initialized = True
+            mark_startup('application_initialized')
+
+recent_updates = RecentUpdates()
+dispatcher = UpdateDispatcher()
+
+def report_trace(trace):
+    metrics.observe(trace)
+    if not LOG_TRACES:
+        return
+    line = {'event': 'update', **trace.to_dict()}
+    if db_pool:
+        line['pool'] = db_pool.get_stats()
+    print(json.dumps(line, ensure_ascii=False))
+
+async def handle_update(update):
+    trace = UpdateTrace(update.update_id)
+    token = current_trace.set(trace)
+    try:
+        await ensure_initialized()
+        if await recent_updates.is_duplicate(db_pool, update.update_id):
+            print(f"Skipping duplicate update {update.update_id}")
+            trace.handler = 'duplicate'
+            return
+
+        # Обрабатываем обновление, подгрузив и затем сохранив состояние пользователя
+        persistence = application.persistence
+        try:
+            if persistence:
+                await persistence.load_session(application, update)
+            await application.process_update(update)
+        except Exception:
+            await recent_updates.forget(db_pool, update.update_id)
+            raise
+        # Апдейт уже обработан: если сессию не удалось записать, она остаётся в памяти
+        # до следующего апдейта, а повторная доставка отбрасывается как дубликат
+        if persistence:
+            await application.update_persistence()
+            if update.effective_user:
+                await persistence.flush(update.effective_user.id)
+        report_cold_start()
+    finally:
+        current_trace.reset(token)
+        trace.finish()
+        report_trace(trace)
 
 # Vercel serverless function handler
 async def handler(request):
@@ -519,20 +1993,115 @@ async def handler(request):
         try:
             # Получаем данные от Telegram
             body = await request.json()
-            update = Update.de_json(body, bot)
+            update = Update.de_json(body, application.bot)
 
-            # Обрабатываем обновление
-            await application.process_update(update)
-            return {"statusCode": 200, "body": "OK"}
+            # Отвечаем Telegram сразу, чтобы медленные команды не вызывали повторную доставку
+            if PROCESS_IN_BACKGROUND:
+                chat = update.effective_chat
+                dispatcher.submit(chat.id if chat else update.update_id, lambda: handle_update(update))
+            else:
+                await handle_update(update)
+            return web.Response(text="OK")
         except Exception as e:
             print(f"Error processing update: {e}")
-            return {"statusCode": 500, "body": str(e)}
-    return {"statusCode": 405, "body": "Method Not Allowed"}
+            return web.Response(status=500, text=str(e))
+    return web.Response(status=405, text="Method Not Allowed")
+
+async def metrics_endpoint(request):
+    """Счётчики обработки апдейтов, пула соединений и попаданий в кэш словаря."""
+    word_cache = application.bot_data.get('word_cache')
+    body = metrics.render(
+        db_pool.get_stats() if db_pool else None,
+        word_cache.stats() if word_cache else None)
+    return web.Response(text=body, headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def compact_history(pool):
+    """Удаляет сырые ответы старше HISTORY_RETENTION_DAYS пачками по COMPACT_BATCH_SIZE.
+
+    В history_daily ответы попадают сразу при записи, поэтому здесь достаточно удалить
+    старые строки. Последние MEMORY_WINDOW ответов каждого слова сохраняются для /memory.
+    """
+    deleted = 0
+    async with pool.connection() as conn:
+        async with conn.cursor() as c:
+            while True:
+                await c.execute(
+                    "DELETE FROM history WHERE id IN ("
+                    "  SELECT h.id FROM history h "
+                    "  WHERE h.timestamp < CURRENT_TIMESTAMP - %(days)s * INTERVAL '1 day' "
+                    "    AND (SELECT COUNT(*) FROM ("
+                    "          SELECT 1 FROM history n WHERE n.word_id = h.word_id AND n.timestamp > h.timestamp "
+                    "          LIMIT %(keep)s) newer) = %(keep)s "
+                    "  LIMIT %(batch)s)",
+                    {'days': HISTORY_RETENTION_DAYS, 'keep': MEMORY_WINDOW, 'batch': COMPACT_BATCH_SIZE})
+                await conn.commit()
+                deleted += c.rowcount
+                if c.rowcount < COMPACT_BATCH_SIZE:
+                    break
+    print(f"Compacted history: {deleted} rows older than {HISTORY_RETENTION_DAYS} days removed")
+    return deleted
+
+async def claim_words(pool, user_id):
+    """Передаёт слова, созданные до появления словарей пользователей (user_id = 0), пользователю.
+
+    Слова, которые у пользователя уже есть, сливаются с ними, как в миграции 3: счётчики
+    ответов складываются, история переносится на его слово, а расписание остаётся его.
+    """
+    user_id = int(user_id)
+    async with pool.connection() as conn:
+        async with conn.cursor() as c:
+            await c.execute(
+                "CREATE TEMP TABLE claim_duplicates ON COMMIT DROP AS "
+                "SELECT o.id, t.id AS keep_id FROM thesaurus o JOIN thesaurus t "
+                "  ON t.user_id = %s "
+                "  AND normalize_word(t.portuguese) = normalize_word(o.portuguese) "
+                "  AND normalize_word(t.russian) = normalize_word(o.russian) "
+                "WHERE o.user_id = 0",
+                (user_id,))
+            await c.execute(
+                "UPDATE stats SET correct = stats.correct + s.correct, incorrect = stats.incorrect + s.incorrect "
+                "FROM stats s JOIN claim_duplicates d ON d.id = s.id WHERE stats.id = d.keep_id")
+            await c.execute(
+                "UPDATE history SET word_id = d.keep_id, user_id = %s "
+                "FROM claim_duplicates d WHERE history.word_id = d.id",
+                (user_id,))
+            await c.execute(
+                "INSERT INTO history_daily (word_id, user_id, day, correct, incorrect) "
+                "SELECT d.keep_id, %s, h.day, h.correct, h.incorrect "
+                "FROM history_daily h JOIN claim_duplicates d ON d.id = h.word_id "
+                "ON CONFLICT (word_id, day) DO UPDATE SET "
+                "  correct = history_daily.correct + EXCLUDED.correct, "
+                "  incorrect = history_daily.incorrect + EXCLUDED.incorrect",
+                (user_id,))
+            # Каскад удаляет stats и history_daily слившихся слов
+            await c.execute("DELETE FROM thesaurus USING claim_duplicates d WHERE thesaurus.id = d.id")
+            print(f"thesaurus: {c.rowcount} duplicate rows merged into words of user {user_id}")
+            for table in ('thesaurus', 'stats', 'history', 'history_daily'):
+                await c.execute(f"UPDATE {table} SET user_id = %s WHERE user_id = 0", (user_id,))
+                print(f"{table}: {c.rowcount} rows assigned to user {user_id}")
+            await bump_vocab_version(c, user_id)
+            await conn.commit()
+
+async def run_command(command, *args):
+    async with create_pool(min_size=1, max_size=1) as pool:
+        await command(pool, *args)
+
+# Служебные команды: python api/webhook.py migrate | compact | claim <user_id>
+COMMANDS = {
+    'migrate': migrate,
+    'compact': compact_history,
+    'claim': claim_words,
+}
 
 # Vercel автоматически вызывает эту функцию
 from aiohttp import web
 app = web.Application()
 app.router.add_post('/', handler)
+if METRICS_ENABLED:
+    app.router.add_get('/metrics', metrics_endpoint)
 
 if __name__ == "__main__":
-    web.run_app(app)
+    if len(sys.argv) >= 2 and sys.argv[1] in COMMANDS:
+        asyncio.run(run_command(COMMANDS[sys.argv[1]], *sys.argv[2:]))
+    else:
+        web.run_app(app)
@@ -0,0 +1,290 @@
+"""Нагрузочный прогон бота без Telegram.
+
+Синтетические апдейты идут через handler() из api/webhook.py так же, как от Telegram:
+/add, /bulk_add файлом на N строк, полные тесты по TEST_SIZE вопросов, /memory и /thesaurus
+на словарях заданных размеров. Бот подменён записывающей заглушкой, поэтому в сеть
+ничего не уходит, а база - настоящий локальный Postgres.
+
+ВНИМАНИЕ: схема public в базе BENCH_DATABASE_URL удаляется и создаётся заново.
+Используйте отдельную одноразовую базу:
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/bench python bench/benchmark.py \\
+        --sizes 1000,10000,100000 --bulk-lines 1000 --tests 3 --concurrency 8
+
+Для каждой команды печатаются p50/p95/p99 задержки, апдейты в секунду и число
+SQL-запросов и вызовов Telegram API на апдейт.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import itertools
+
+BENCH_DATABASE_URL = os.getenv("BENCH_DATABASE_URL")
+if not BENCH_DATABASE_URL:
+    sys.exit("Укажите BENCH_DATABASE_URL - отдельную базу, которую можно очистить")
+
+# Окружение задаётся до импорта бота: апдейты обрабатываются синхронно, без логов трассировки
+# и без ограничителя исходящих сообщений - заглушка Telegram лимитов не имеет
+os.environ.update({
+    'DATABASE_URL': BENCH_DATABASE_URL,
+    'TOKEN': '123456:BENCHMARK',
+    'BOT_USERNAME': 'benchmark_bot',
+    'PROCESS_IN_BACKGROUND': '0',
+    'LOG_TRACES': '0',
+    'RATE_LIMIT_ENABLED': '0',
+})
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+import webhook
+from telegram.request import BaseRequest
+
+class RecordingRequest(BaseRequest):
+    """Заглушка Telegram API: отвечает как сервер и записывает вызовы в трассировку апдейта.
+    Слишком длинный текст отклоняется ошибкой 400, как это делает Telegram; файлы из files
+    отдаются через getFile и скачивание по file_path."""
+
+    def __init__(self):
+        self.sent = {}
+        self.rejected = []
+        self.files = {}
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if '/file/bot' in url:
+            return 200, self.files[endpoint]
+        if 'text' in params:
+            self.sent.setdefault(params.get('chat_id'), []).append(params['text'])
+        trace = webhook.current_trace.get()
+        if trace:
+            trace.telegram.append({'method': endpoint, 'ms': 0.0})
+        if len(params.get('text', '')) > webhook.MESSAGE_LIMIT:
+            self.rejected.append(f"{endpoint}: {len(params['text'])} символов")
+            return 400, b'{"ok": false, "error_code": 400, "description": "Bad Request: message is too long"}'
+        if endpoint == 'answerCallbackQuery':
+            return 200, b'{"ok": true, "result": true}'
+        if endpoint == 'getFile':
+            file_id = params['file_id']
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_path': file_id,
+                      'file_size': len(self.files[file_id])}
+            return 200, json.dumps({'ok': True, 'result': result}).encode()
+        result = {
+            'message_id': next(self._message_ids), 'date': 0,
+            'chat': {'id': params.get('chat_id', 0), 'type': 'private'},
+            'text': params.get('text', ''),
+        }
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+class Request:
+    method = 'POST'
+
+    def __init__(self, body):
+        self.body = body
+
+    async def json(self):
+        return self.body
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+def message(user_id, text=None, document=None):
+    msg = {
+        'message_id': next(message_ids), 'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+    }
+    if document:
+        msg['document'] = document
+    else:
+        msg['text'] = text
+    if text and text.startswith('/'):
+        msg['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(update_ids), 'message': msg}
+
+def upload(file_name, data):
+    """Кладёт файл в заглушку Telegram и возвращает документ для сообщения."""
+    file_id = f'file{next(message_ids)}'
+    webhook.application.bot._request[1].files[file_id] = data
+    return {'file_id': file_id, 'file_unique_id': file_id, 'file_name': file_name, 'file_size': len(data)}
+
+class Results:
+    """Задержка и число запросов каждого апдейта, сгруппированные по команде."""
+
+    def __init__(self):
+        self.samples = {}
+        self.traces = {}
+
+    def record(self, command, update_id, seconds):
+        trace = self.traces.pop(update_id, None)
+        self.samples.setdefault(command, []).append(
+            (seconds, len(trace.queries) if trace else 0, len(trace.telegram) if trace else 0))
+
+    def summary(self):
+        rows = []
+        for command, samples in self.samples.items():
+            latencies = sorted(seconds for seconds, _, _ in samples)
+            total = sum(latencies)
+            rows.append({
+                'command': command,
+                'updates': len(samples),
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'updates_per_sec': len(samples) / total if total else None,
+                'queries_per_update': sum(q for _, q, _ in samples) / len(samples),
+                'max_queries': max(q for _, q, _ in samples),
+                'telegram_per_update': sum(t for _, _, t in samples) / len(samples),
+            })
+        return rows
+
+def percentile(values, p):
+    """Ближайший ранг по отсортированному списку."""
+    index = max(0, -(-len(values) * p // 100) - 1)
+    return values[int(index)]
+
+results = Results()
+
+async def send(command, body):
+    # Ошибки Telegram обработчик не пробрасывает, поэтому отказы заглушки проверяем отдельно
+    rejected = webhook.application.bot._request[1].rejected
+    before = len(rejected)
+    started = time.perf_counter()
+    response = await webhook.handler(Request(body))
+    results.record(command, body['update_id'], time.perf_counter() - started)
+    if response.status != 200:
+        raise RuntimeError(f"{command}: {response.text}")
+    if len(rejected) > before:
+        raise RuntimeError(f"{command}: Telegram отклонил {', '.join(rejected[before:])}")
+
+async def reset_database(pool):
+    async with pool.connection() as conn:
+        await conn.execute("DROP SCHEMA public CASCADE")
+        await conn.execute("CREATE SCHEMA public")
+        await conn.commit()
+    await webhook.migrate(pool)
+
+async def seed_vocabulary(pool, user_id, size):
+    """Словарь из size пар и по три ответа на каждое десятое слово для /memory."""
+    async with pool.connection() as conn:
+        async with conn.cursor() as c:
+            await c.execute(
+                "WITH t AS ("
+                "  INSERT INTO thesaurus (user_id, portuguese, russian) "
+                "  SELECT %s, 'pt' || i, 'ru' || i FROM generate_series(1, %s) i "
+                "  RETURNING id, user_id"
+                ") INSERT INTO stats (id, user_id) SELECT id, user_id FROM t",
+                (user_id, size))
+            await c.execute(
+                "INSERT INTO history (word_id, user_id, correct) "
+                "SELECT id, user_id, (id + n) %% 2 FROM thesaurus, generate_series(1, 3) n "
+                "WHERE user_id = %s AND id %% 10 = 0",
+                (user_id,))
+            await conn.commit()
+    async with pool.connection() as conn:
+        await conn.execute("ANALYZE")
+
+def correct_answer(question):
+    # Вопрос заканчивается словом в звёздочках: 'pt12' переводится как 'ru12' и наоборот
+    word = question.rsplit('*', 2)[-2]
+    return ('ru' if word.startswith('pt') else 'pt') + word[2:]
+
+async def run_test(user_id, label):
+    """Полный тест: /test и правильный ответ на каждый вопрос."""
+    sent = webhook.application.bot._request[1].sent
+    sent.pop(user_id, None)
+    await send(f'{label} /test', message(user_id, '/test random'))
+    for _ in range(webhook.TEST_SIZE):
+        questions = [text for text in sent.pop(user_id, []) if '❓' in text]
+        if not questions:
+            break
+        await send(f'{label} answer', message(user_id, correct_answer(questions[-1])))
+
+async def run_size(size, user_id, args):
+    label = f'{size:>6}'
+    await seed_vocabulary(webhook.db_pool, user_id, size)
+
+    for i in range(args.repeat):
+        await send(f'{label} /add', message(user_id, '/add'))
+        await send(f'{label} /add', message(user_id, f'novo{i}'))
+        await send(f'{label} /add', message(user_id, f'новое{i}'))
+
+    # Больше 4096 символов Telegram в сообщении не доставит, поэтому список идёт файлом
+    lines = '\n'.join(f'bulk{size}x{i} - пакет{i}' for i in range(args.bulk_lines))
+    await send(f'{label} /bulk_add', message(user_id, '/bulk_add'))
+    await send(f'{label} /bulk_add', message(user_id, document=upload('words.txt', lines.encode())))
+
+    for _ in range(args.tests):
+        await run_test(user_id, label)
+
+    for _ in range(args.repeat):
+        await send(f'{label} /thesaurus', message(user_id, '/thesaurus'))
+        await send(f'{label} /memory', message(user_id, '/memory'))
+
+async def run_concurrent(args, first_user_id):
+    """Несколько пользователей одновременно проходят тесты: пропускная способность под нагрузкой."""
+    users = [first_user_id + i for i in range(args.concurrency)]
+    for user_id in users:
+        await seed_vocabulary(webhook.db_pool, user_id, webhook.TEST_CANDIDATES)
+    started = time.perf_counter()
+    before = sum(len(samples) for samples in results.samples.values())
+    await asyncio.gather(*(run_test(user_id, 'concurrent') for user_id in users))
+    elapsed = time.perf_counter() - started
+    updates = sum(len(samples) for samples in results.samples.values()) - before
+    return {'users': len(users), 'updates': updates, 'seconds': elapsed, 'updates_per_sec': updates / elapsed}
+
+def print_table(rows, concurrent):
+    header = f"{'command':<20} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'upd/s':>8} {'sql/upd':>8} {'sql max':>8} {'tg/upd':>7}"
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        print(f"{row['command']:<20} {row['updates']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+              f"{row['p99_ms']:>9.1f} {row['updates_per_sec']:>8.1f} {row['queries_per_update']:>8.2f} "
+              f"{row['max_queries']:>8} {row['telegram_per_update']:>7.2f}")
+    if concurrent:
+        print(f"\n{concurrent['users']} пользователей одновременно: {concurrent['updates']} апдейтов "
+              f"за {concurrent['seconds']:.2f} с, {concurrent['updates_per_sec']:.1f} апдейтов/с")
+
+async def main(args):
+    recorder = RecordingRequest()
+    webhook.application.bot._request = (recorder, recorder)
+
+    # Трассировку каждого апдейта забираем себе, чтобы посчитать запросы
+    report_trace = webhook.report_trace
+
+    def collect(trace):
+        results.traces[trace.update_id] = trace
+        report_trace(trace)
+    webhook.report_trace = collect
+
+    await reset_database(webhook.db_pool)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    for i, size in enumerate(sizes):
+        await run_size(size, 1000 + i, args)
+    concurrent = await run_concurrent(args, 2000) if args.concurrency else None
+
+    rows = results.summary()
+    print_table(rows, concurrent)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'commands': rows, 'concurrent': concurrent}, f, ensure_ascii=False, indent=2)
+    await webhook.db_pool.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон бота на локальном Postgres')
+    parser.add_argument('--sizes', default='1000,10000', help='размеры словарей через запятую')
+    parser.add_argument('--bulk-lines', type=int, default=1000, help='строк в одном /bulk_add')
+    parser.add_argument('--tests', type=int, default=3, help='полных тестов на каждый словарь')
+    parser.add_argument('--repeat', type=int, default=5, help='повторов /add, /thesaurus и /memory')
+    parser.add_argument('--concurrency', type=int, default=8, help='пользователей в параллельном прогоне, 0 - без него')
+    parser.add_argument('--json', help='сохранить результаты в файл')
+    asyncio.run(main(parser.parse_args()))